@@ -1,35 +1,49 @@
+import bisect
+import gzip
+import hashlib
 import logging
 import random
 import sys
+import threading
 import time
 import warnings
 
 import dash
 import dash_mantine_components as dmc
-import dash_core_components as dcc
-import dash_html_components as html
+from dash import dcc, html
 import numpy as np
 import pandas as pd
 from dash.dependencies import Input, Output, State
+from dash.exceptions import PreventUpdate
+from flask import Response, abort, request
 from flask_caching import Cache
 
 import plotly.express as px
 
+from cache_backends import get_cache_config
 from config import config as cfg
 from figures_utils import (
+    downsample_timeseries,
     get_average_price_by_year,
     get_figure,
+    get_figure_patch,
     price_ts,
     price_volume_ts,
 )
+from instrumentation import init_instrumentation, instrument_callback, register_collector, span
+from response_encoding import init_response_encoding
+from snapshot_cache import SnapshotCache
 from utils import (
-    get_geo_data,
-    get_all_data_for_region_and_var,
-    get_all_data_for_timeperiod_and_var,
+    get_app_lookups,
+    get_data_version,
+    get_geo_feature_index,
+    get_geo_data_tier_paths,
+    get_geodata_tier,
+    get_vector_tile,
+    get_highlight_geojson,
+    get_map_value_range,
+    get_region_timeseries,
     get_variable_info,
-    get_all_region_info,
-    get_timeperiod_info,
-    get_end_dates_for_durations,
 )
 
 warnings.filterwarnings("ignore")
@@ -61,19 +75,43 @@ initial_regions  = [19740, 14500, 22660] # Denver, Boulder, Ft. Collins metros
 max_selected_regions = 5
 
 
-geo_data, geo_data_paths = get_geo_data()
+# geometry itself is only loaded if needed, see get_geo_feature_index
+geo_data_tier_paths = get_geo_data_tier_paths()
+initial_geo_tier = get_geodata_tier(cfg['plotly_config']['all']['zoom'])
 
 variable_info = get_variable_info().sort_values('variable')
 var_pretty_name_lut = {v.variable:v.pretty_name for v in  variable_info.itertuples()}
 key_variable_info = variable_info.query('key_var')
 assert initial_variable in key_variable_info.variable.tolist(), 'initial_variable must be a key variable'
+app_lookups = get_app_lookups()
 # a dictionary with {region_id:region_name,} for some things
-region_id_lut = get_all_region_info()
+region_id_lut = app_lookups['region_id_lut']
 # a data.frame with the same info for other things.
-region_id_df  = get_all_region_info(return_mapping=False) 
+region_id_df  = app_lookups['region_id_df']
+
+time_period_info = app_lookups['time_period_info']
+duration_period_end_dates = app_lookups['duration_period_end_dates']
+# md5 of the redfin file behind the current database, see reload_lookups_on_new_data
+data_version = app_lookups['data_version']
+reload_lock = threading.Lock()
+# time.monotonic() after which the data version is checked again
+next_version_check = 0
+
+# Map data for the most recent date of every key variable is loaded up front.
+snapshot_cache = SnapshotCache(
+    max_bytes=cfg["snapshot cache max MB"] * 1024**2,
+    prefetch_workers=cfg["snapshot cache prefetch workers"],
+)
+
+def get_prewarm_keys():
+    return [
+        (variable, duration, max(period_end_dates), data_version)
+        for variable in key_variable_info.variable
+        for duration, period_end_dates in duration_period_end_dates.items()
+    ]
 
-time_period_info = get_timeperiod_info()
-duration_period_end_dates = get_end_dates_for_durations()
+if cfg["snapshot cache prewarm"]:
+    snapshot_cache.prewarm(get_prewarm_keys())
 
 """ ----------------------------------------------------------------------------
  Dash App
@@ -90,16 +128,109 @@ app = dash.Dash(
 )
 
 server = app.server  # Needed for gunicorn
-cache = Cache(
-    server,
-    config={
-        "CACHE_TYPE": "filesystem",
-        "CACHE_DIR": cfg["cache dir"],
-        "CACHE_THRESHOLD": cfg["cache threshold"],
-    },
-)
+cache = Cache(server, config=get_cache_config(cfg))
+# before the callbacks are defined, and before response encoding so its
+# compression is included in the serialize stage
+init_instrumentation(server, enable=cfg["instrumentation"])
+init_response_encoding(server, min_bytes=cfg["response_compress_min_bytes"])
+
+
+def versioned_name(fname):
+    """ make_name for cache.memoize, so cached results are per data version """
+    return f"{fname}:{data_version}"
+
+
+@server.before_request
+def reload_lookups_on_new_data():
+    """
+    After ingest_raw_data.py puts in a new database, reload the lookups built
+    at startup. Memoized results and the snapshot cache are keyed on
+    data_version, so they move to the new data at the same time. The new
+    layout is served to browsers loading the page from then on.
+    
+    The database file is checked at most every data_version_check_seconds.
+    """
+    global app_lookups, region_id_lut, region_id_df, time_period_info, duration_period_end_dates, data_version
+    global next_version_check
+    now = time.monotonic()
+    if now < next_version_check:
+        return
+    next_version_check = now + cfg["data_version_check_seconds"]
+    if get_data_version() == data_version:
+        return
+
+    with reload_lock:
+        # another thread may have got here first
+        if get_data_version() == data_version:
+            return
+        new_lookups = get_app_lookups()
+        app_lookups = new_lookups
+        region_id_lut = new_lookups["region_id_lut"]
+        region_id_df = new_lookups["region_id_df"]
+        time_period_info = new_lookups["time_period_info"]
+        duration_period_end_dates = new_lookups["duration_period_end_dates"]
+        logging.info(f"data version changed from {data_version} to {new_lookups['data_version']}, lookups reloaded")
+        data_version = new_lookups["data_version"]
+        snapshot_cache.clear()
+        if cfg["snapshot cache prewarm"]:
+            # in the background, so this request is not held up by it
+            snapshot_cache.prefetch(get_prewarm_keys())
+
 app.config.suppress_callback_exceptions = True
 
+
+@server.route("/tiles/<geo_type>/<int:z>/<int:x>/<int:y>.pbf")
+def vector_tile(geo_type, z, x, y):
+    if geo_type not in cfg["vector_tile_files"]:
+        abort(404)
+
+    try:
+        tile_data = get_vector_tile(geo_type, z, x, y)
+    except FileNotFoundError:
+        # the mbtiles file has not been written
+        abort(404)
+    if tile_data is None:
+        return Response(status=204)
+
+    # tiles are stored gzipped, so only decompress for clients without gzip
+    if "gzip" in request.accept_encodings:
+        response = Response(tile_data, mimetype="application/x-protobuf")
+        response.headers["Content-Encoding"] = "gzip"
+    else:
+        response = Response(gzip.decompress(tile_data), mimetype="application/x-protobuf")
+    response.headers["Vary"] = "Accept-Encoding"
+    response.cache_control.public = True
+    response.cache_control.max_age = 24 * 60 * 60
+    response.set_etag(hashlib.md5(tile_data).hexdigest())
+    return response.make_conditional(request)
+
+
+def get_tile_urls(geo_types):
+    """ {layer_name: tile url} for the vector tiles of geo_types """
+    layer_names = ["counties", "metros"] if geo_types == "all" else [geo_types]
+    return {
+        layer_name: request.host_url.rstrip("/") + app.get_relative_path(f"/tiles/{layer_name}/{{z}}/{{x}}/{{y}}.pbf")
+        for layer_name in layer_names
+    }
+
+
+@server.route("/snapshot-cache/stats")
+def snapshot_cache_stats():
+    return snapshot_cache.stats()
+
+
+def snapshot_cache_metrics():
+    stats = snapshot_cache.stats()
+    return {
+        "snapshot_cache_hits_total": ("counter", "Snapshot cache hits", stats["hits"]),
+        "snapshot_cache_misses_total": ("counter", "Snapshot cache misses", stats["misses"]),
+        "snapshot_cache_evictions_total": ("counter", "Snapshot cache evictions", stats["evictions"]),
+        "snapshot_cache_entries": ("gauge", "Maps in the snapshot cache", stats["entries"]),
+        "snapshot_cache_bytes": ("gauge", "Bytes of map data in the snapshot cache", stats["bytes"]),
+    }
+
+register_collector(snapshot_cache_metrics)
+
 style = dict(
     margin = '0px',
     padding = '0px',
@@ -124,22 +255,32 @@ variable_dropdown = dmc.Select(
     #style={"width": 200, "marginBottom": 10},
 )
 
+# Play mode, which steps the map through the dates after period_end
+play_controls = html.Div([
+    dmc.Button("Play", id="play", size="xs", style={"marginTop": 25}),
+    # date of the frame shown while playing
+    dmc.Text(id="play_date", size="xs"),
+    dcc.Interval(id="play_interval", interval=cfg["play_interval_ms"], disabled=True),
+    dcc.Store(id="map_frames"),
+    ])
+
 #TODO: ensure max_selected_regions on map clicking
-region_dropdown = dmc.MultiSelect(
-    label="Regions to view in timeseries.",
-    #placeholder="Select all you like!",
-    id="region_id",
-    value=initial_regions,
-    data=[
-        {"label": r_lab, "value": r_id}
-        for r_id, r_lab in region_id_lut['counties'].items()
-    ],
-    searchable=True,
-    clearable=True,
-    maxSelectedValues=max_selected_regions,
-    style=style,
-    #style={"width": 400, "marginBottom": 10},
-)
+def get_region_dropdown():
+    return dmc.MultiSelect(
+        label="Regions to view in timeseries.",
+        #placeholder="Select all you like!",
+        id="region_id",
+        value=initial_regions,
+        data=[
+            {"label": r_lab, "value": r_id}
+            for r_id, r_lab in region_id_lut['counties'].items()
+        ],
+        searchable=True,
+        clearable=True,
+        maxSelectedValues=max_selected_regions,
+        style=style,
+        #style={"width": 400, "marginBottom": 10},
+    )
 
 
 duration_dropdown = dmc.Select(
@@ -176,91 +317,107 @@ variable_type_radio = dmc.RadioGroup(
 )
 
 
-period_dropdown = dmc.Select(
-    id="period_end",
-    label="Date",
-    # most recent date as default
-    value=max(duration_period_end_dates[initial_duration]),
-    data=[
-        {"label": i, "value": i}
-        for i in duration_period_end_dates[initial_duration]
-    ],
-    style=style,
-    #style={"width": 200, "marginBottom": 10},
-)
+def get_period_dropdown():
+    return dmc.Select(
+        id="period_end",
+        label="Date",
+        # most recent date as default
+        value=max(duration_period_end_dates[initial_duration]),
+        data=[
+            {"label": i, "value": i}
+            for i in duration_period_end_dates[initial_duration]
+        ],
+        style=style,
+        #style={"width": 200, "marginBottom": 10},
+    )
 
 
 #--------------------------------------------------------
 # Layout and styling
 
-app.layout = dmc.MantineProvider(
-    withGlobalStyles=True,
-    theme={
-    "colorScheme": "dark",
-    # "shadows": {
-    #     # other shadows (xs, sm, lg) will be merged from default theme
-    #     "md": "1px 1px 3px rgba(0,0,0,.25)",
-    #     "xl": "5px 5px 3px rgba(0,0,0,.25)",
-    # },
-    "headings": {
-        "fontFamily": "Roboto, sans-serif",
-        "sizes": {
-            "h1": {"fontSize": 30},
+# A function, so each page load gets the regions and dates of the current data
+def serve_layout():
+    return dmc.MantineProvider(
+        withGlobalStyles=True,
+        theme={
+        "colorScheme": "dark",
+        # "shadows": {
+        #     # other shadows (xs, sm, lg) will be merged from default theme
+        #     "md": "1px 1px 3px rgba(0,0,0,.25)",
+        #     "xl": "5px 5px 3px rgba(0,0,0,.25)",
+        # },
+        "headings": {
+            "fontFamily": "Roboto, sans-serif",
+            "sizes": {
+                "h1": {"fontSize": 30},
+            },
         },
-    },
-    'style' : {
-        'margin' : '0px',
-        'padding' : '0px',
-        }
-    },
-    children=[
-        # Header
-        dmc.Grid(
-            children = [
-                dmc.Col(title_text, span='content'),
-                dmc.Col(data_attibution_markdown, span='content'),
-                dmc.Col(span='auto'), # empty col to push the made_with_text to the right side
-                dmc.Col(made_with_text, span='content'),
-                ],
-            align = 'center',
-            ),
+        'style' : {
+            'margin' : '0px',
+            'padding' : '0px',
+            }
+        },
+        children=[
+            # Header
+            dmc.Grid(
+                children = [
+                    dmc.Col(title_text, span='content'),
+                    dmc.Col(data_attibution_markdown, span='content'),
+                    dmc.Col(span='auto'), # empty col to push the made_with_text to the right side
+                    dmc.Col(made_with_text, span='content'),
+                    ],
+                align = 'center',
+                ),
         
-        dmc.Space(h=10),
+            dmc.Space(h=10),
         
-        # Selection components
-        dmc.Grid(
-            children = [
-                dmc.Col(variable_dropdown, span=2),
-                dmc.Col(region_dropdown, span=5),
-                dmc.Col(duration_dropdown, span=1),
-                dmc.Col(period_dropdown, span=1),
-                dmc.Col(geotype_checklist, span=1),
-                dmc.Col(variable_type_radio, span=1),
-                ],
-            align = 'flex-start'
-            ),
+            # Selection components
+            dmc.Grid(
+                children = [
+                    dmc.Col(variable_dropdown, span=2),
+                    dmc.Col(get_region_dropdown(), span=5),
+                    dmc.Col(duration_dropdown, span=1),
+                    dmc.Col(get_period_dropdown(), span=1),
+                    dmc.Col(play_controls, span='content'),
+                    dmc.Col(geotype_checklist, span=1),
+                    dmc.Col(variable_type_radio, span=1),
+                    ],
+                align = 'flex-start'
+                ),
         
-        dmc.Space(h=5),
+            dmc.Space(h=5),
         
-        # Map title
-        dmc.Grid(
-            children = [
-                dmc.Col(html.H4(id="choropleth-title"), span='content', style=style)
-                ],
-            align = 'flex-start',
-            style=style,
-            ),
+            # Map title
+            dmc.Grid(
+                children = [
+                    dmc.Col(html.H4(id="choropleth-title"), span='content', style=style)
+                    ],
+                align = 'flex-start',
+                style=style,
+                ),
         
-        # Map and timeseries chart
-        dmc.Grid(
-            children = [
-                dmc.Col(dcc.Graph(id="choropleth"), span=7),
-                dmc.Col(dcc.Graph(id="price-time-series"), span=5)
-                ],
-            align = 'flex-start'
-            ),
-    ],
-    )
+            # Map and timeseries chart
+            dmc.Grid(
+                children = [
+                    dmc.Col([
+                        dcc.Graph(id="choropleth"),
+                        # geodata tier for the current map zoom
+                        dcc.Store(id="geo_tier", data=initial_geo_tier),
+                        # data version of the map in the browser, see update_Choropleth
+                        dcc.Store(id="map_data_version"),
+                        ], span=7),
+                    dmc.Col([
+                        dcc.Graph(id="price-time-series"),
+                        # chart width in pixels, set in the browser
+                        dcc.Store(id="timeseries_width"),
+                        ], span=5)
+                    ],
+                align = 'flex-start'
+                ),
+        ],
+        )
+
+app.layout = serve_layout
 
 
 """ ----------------------------------------------------------------------------
@@ -285,6 +442,7 @@ app.layout = dmc.MantineProvider(
         #Input("school-checklist", "value"),
     ],
 )
+@instrument_callback
 def update_map_title(variable, duration, geo_types, period_end):
     if 'metros' in geo_types and 'counties' in geo_types:
         geo_type_text= 'Counties and Metro Areas'
@@ -311,6 +469,7 @@ def update_map_title(variable, duration, geo_types, period_end):
      Input("variable_type", "value"), 
      ]
 )
+@instrument_callback
 def update_variable_entries(variable_type):
     if variable_type == 'all_vars':
         var_df = variable_info
@@ -328,6 +487,7 @@ def update_variable_entries(variable_type):
      Input("geo_types", "value"), 
      ]
 )
+@instrument_callback
 def update_region_entries(geo_types):
     region_list = []
     for gtype in geo_types:
@@ -344,18 +504,57 @@ def update_region_entries(geo_types):
      Input('duration','value'),
      ]
 )
+@instrument_callback
 def update_end_date_entries(duration):
     return duration_period_end_dates[duration]
 
+def get_adjacent_periods(duration, period_end, n_before, n_after):
+    """ Up to n_before period_end dates before period_end and n_after after, each in date order """
+    # duration_period_end_dates are 'YYYY-MM-DD' and most recent first
+    period_ends = duration_period_end_dates[duration][::-1]
+    i = bisect.bisect_left(period_ends, period_end)
+    j = bisect.bisect_right(period_ends, period_end)
+    return period_ends[max(i - n_before, 0):i], period_ends[j:j + n_after]
+
+def prefetch_adjacent_periods(variable, duration, period_end):
+    """ Load the dates either side of period_end into the snapshot cache in the background """
+    n = cfg["snapshot cache prefetch periods"]
+    before, after = get_adjacent_periods(duration, period_end, n, n)
+    snapshot_cache.prefetch((variable, duration, p, data_version) for p in after + before[::-1])
+
+# Switch to a more or less simplified geometry when the map zoom crosses a tier.
+# Pans and zooms within a tier do not update anything.
+@app.callback(
+    Output("geo_tier", "data"),
+    [
+     Input("choropleth", "relayoutData"),
+     State("geo_tier", "data"),
+     ]
+)
+@instrument_callback
+def update_geo_tier(relayoutData, current_tier):
+    if not relayoutData or "mapbox.zoom" not in relayoutData:
+        raise PreventUpdate
+
+    geo_tier = get_geodata_tier(relayoutData["mapbox.zoom"])
+    if geo_tier == current_tier:
+        raise PreventUpdate
+    return geo_tier
+
 # Update choropleth-graph with year, region, graph-type update & sectors
 @app.callback(
-    Output("choropleth", "figure"),
+    [
+        Output("choropleth", "figure"),
+        Output("map_data_version", "data"),
+    ],
     [
         Input('variable','value'),
         Input("geo_types", "value"), 
         Input("duration", "value"),
         Input("region_id", "value"),
         Input("period_end", "value"),
+        Input("geo_tier", "data"),
+        State("map_data_version", "data"),
       #  Input("year", "value"),
       #  Input("region", "value"),
       #  Input("graph-type", "value"),
@@ -363,16 +562,21 @@ def update_end_date_entries(duration):
       #  Input("school-checklist", "value"),
     ],
 )  # @cache.memoize(timeout=cfg['timeout'])
-def update_Choropleth(variable, geo_types, duration, region_ids, period_end):
+@instrument_callback
+def update_Choropleth(variable, geo_types, duration, region_ids, period_end, geo_tier, map_version):
+    # None when the selection is cleared
+    region_ids = region_ids or []
     if 'metros' in geo_types and 'counties' in geo_types:
         geo_types='all'
     else:
         geo_types=geo_types[0]
     
     
-    logging.info('update_choropleth: setting things up')
     #variable = initial_variable
-    df = get_all_data_for_timeperiod_and_var(variable, duration=duration, period_end=period_end)
+    with span('query'):
+        map_region_ids, map_values = snapshot_cache.get(variable, duration, period_end, data_version)
+    prefetch_adjacent_periods(variable, duration, period_end)
+    df = pd.DataFrame({'region_id': map_region_ids, variable: map_values})
     #df = get_all_data_for_region_and_var(region_id=2772, variable=variable)
     # counties only
 
@@ -382,39 +586,56 @@ def update_Choropleth(variable, geo_types, duration, region_ids, period_end):
     
     df['Price'] = df[variable]
     
-    df = df.merge(region_id_df[['region_id','region_name']], how='left', on='region_id')
+    # Every region, in the same order, for every update. Regions without data
+    # are NaN and not drawn. This keeps locations fixed for map_update_mode patch. 
+    with span('merge'):
+        df = region_id_df[['region_id','region_name']].merge(df, how='left', on='region_id')
     
-    def format_hover_text(i):
-        outline = '{name}<br>{variable}: {value}'
-        return outline.format(
-            name = i.region_name,
-            variable = var_pretty_name_lut[variable],
-            value = round(i[variable],2)
-            )
-    df['text'] = df.apply(format_hover_text, axis=1)
+    # precomputed colour range, so no quantiles over df here
+    with span('colour_range'):
+        value_range = get_map_value_range(variable, duration, period_end, geo_types, scope=cfg['map_colour_range'])
     
     # For high-lighting mechanism ----------------------# 
     #---------probably need to use below to highlight on map those values cliked in bar------------------
     changed_id = [p["prop_id"] for p in dash.callback_context.triggered][0]
-
-    if "geo_types" not in changed_id:
-        highlighted_geoms = geo_data[geo_types].query("region_id.isin(@region_ids)").__geo_interface__
+    geo_url = app.get_asset_url(geo_data_tier_paths[geo_types][geo_tier])
+    highlight_ids = None
+
+    if cfg['map_update_mode'] == 'patch':
+        # Only the geometry type or tier changes the figure structure, everything
+        # else is a partial update of the figure already in the browser. Unless
+        # the data was reloaded since, when its regions can be in another order.
+        if (changed_id.split('.')[0] in ['variable', 'duration', 'period_end', 'region_id']
+                and map_version == data_version):
+            with span('figure'):
+                return get_figure_patch(df, 'Price', hover_label=var_pretty_name_lut[variable], highlight_ids=region_ids, value_range=value_range), data_version
+        # Highlights are drawn from the same geojson url, so no geometry is sent. 
+        highlighted_geoms = geo_url
+        highlight_ids = region_ids
+    elif "geo_types" not in changed_id:
+        with span('highlight'):
+            highlighted_geoms = get_highlight_geojson(get_geo_feature_index(geo_types, geo_tier), region_ids)
     else:
         highlighted_geoms = None
 
     
-    fig = get_figure(
-        df = df,
-        geo_data = app.get_asset_url(geo_data_paths[geo_types]),
-        region=geo_types,
-        gtype='Price', #TODO, get rid of this. have a single val column in all data
-        year=None,
-        geo_sectors=highlighted_geoms,
-        school=[],
-        schools_top_500=None,
-    )
+    with span('figure'):
+        fig = get_figure(
+            df = df,
+            geo_data = geo_url,
+            region=geo_types,
+            gtype='Price', #TODO, get rid of this. have a single val column in all data
+            year=None,
+            geo_sectors=highlighted_geoms,
+            school=[],
+            schools_top_500=None,
+            hover_label=var_pretty_name_lut[variable],
+            highlight_ids=highlight_ids,
+            outline_tiles=get_tile_urls(geo_types) if cfg['vector_tile_outlines'] else None,
+            value_range=value_range,
+        )
     
-    return fig
+    return fig, data_version
     
     # Graph type selection------------------------------#
     if gtype in ["Price", "Volume"]:
@@ -438,6 +659,177 @@ def update_Choropleth(variable, geo_types, duration, region_ids, period_end):
     return fig
 
 
+def get_map_frames(variable, duration, period_end, region_ids, geo_types, with_regions=False):
+    """
+    Map values for play mode, for play_frames dates starting at period_end.
+    Each frame is the values in region_id_df order, the order of the map 
+    locations, so the browser only swaps z. The colour range is the one over
+    all dates, so colours are comparable between frames.
+    
+    with_regions also sends the region ids and names, for a map from before 
+    the data was reloaded, whose regions can be in another order.
+    """
+    n = cfg["play_frames"]
+    before, after = get_adjacent_periods(duration, period_end, n, n - 1)
+    period_ends = [period_end] + after
+    if len(period_ends) < n:
+        # close to the most recent date, so play up to it instead
+        period_ends = (before + period_ends)[-n:]
+    
+    keys = [(variable, duration, p, data_version) for p in period_ends]
+    # loaded in parallel, and get below waits for each
+    snapshot_cache.prefetch(keys)
+    
+    locations = pd.Index(region_id_df["region_id"])
+    z = np.full((len(keys), len(locations)), np.nan)
+    for i, key in enumerate(keys):
+        map_region_ids, map_values = snapshot_cache.get(*key)
+        positions = locations.get_indexer(map_region_ids)
+        found = positions >= 0
+        z[i, positions[found]] = map_values[found]
+    
+    # so playing on from the last frame is cached too
+    _, upcoming = get_adjacent_periods(duration, period_ends[-1], 0, n)
+    snapshot_cache.prefetch((variable, duration, p, data_version) for p in upcoming)
+    
+    geo_type = "all" if len(geo_types) > 1 else geo_types[0]
+    value_range = get_map_value_range(variable, duration, period_end, geo_type, scope="global")
+    if value_range is None:
+        value_range = np.nanpercentile(z, [5, 95])
+    
+    # Regions of the highlight trace. In full mode it has every region, see update_Choropleth
+    highlight_index = None
+    if cfg["map_update_mode"] == "patch":
+        highlight_index = np.flatnonzero(locations.isin(region_ids)).tolist()
+    
+    # NaN is not valid json, missing values are null
+    z_values = np.round(z, 2).astype(object)
+    z_values[np.isnan(z)] = None
+    
+    return dict(
+        period_ends = period_ends,
+        z = z_values.tolist(),
+        zmin = float(value_range[0]),
+        zmax = float(value_range[1]),
+        highlight_index = highlight_index,
+        locations = region_id_df["region_id"].tolist() if with_regions else None,
+        customdata = region_id_df["region_name"].tolist() if with_regions else None,
+        )
+
+# Start or stop play mode. Starting sends the map values for the next dates
+# in one go, and stopping leaves the map on the last date shown. A new 
+# selection also stops it.
+@app.callback(
+    [
+     Output("play_interval", "disabled"),
+     Output("play_interval", "n_intervals"),
+     Output("play", "children"),
+     Output("map_frames", "data"),
+     Output("period_end", "value"),
+     ],
+    [
+     Input("play", "n_clicks"),
+     Input('variable','value'),
+     Input("duration", "value"),
+     Input("region_id", "value"),
+     Input("geo_types", "value"),
+     State("play_interval", "disabled"),
+     State("play_date", "children"),
+     State("period_end", "value"),
+     State("map_data_version", "data"),
+     ],
+    prevent_initial_call=True,
+)
+@instrument_callback
+def toggle_play(n_clicks, variable, duration, region_ids, geo_types, stopped, play_date, period_end, map_version):
+    changed_id = [p["prop_id"] for p in dash.callback_context.triggered][0]
+    if changed_id != "play.n_clicks":
+        if stopped:
+            raise PreventUpdate
+        return True, 0, "Play", None, dash.no_update
+    
+    if not stopped:
+        return True, 0, "Play", dash.no_update, play_date or dash.no_update
+    
+    frames = get_map_frames(variable, duration, period_end, region_ids or [], geo_types,
+                            with_regions=map_version != data_version)
+    return False, 0, "Pause", frames, dash.no_update
+
+# Show each play mode frame by swapping the values of the map in the browser,
+# with no request to the server. The map figure is also an output of 
+# update_Choropleth, so this needs allow_duplicate, new in dash 2.9, see 
+# requirements.txt.
+app.clientside_callback(
+    """
+    function(n_intervals, frames, figure) {
+        var no_update = window.dash_clientside.no_update;
+        if (!frames || !figure) {
+            return [no_update, no_update];
+        }
+        var i = n_intervals % frames.period_ends.length;
+        var z = frames.z[i];
+        var range = {zmin: frames.zmin, zmax: frames.zmax};
+        var data = figure.data.slice();
+        var pick = function(values) {
+            return frames.highlight_index === null ? values : frames.highlight_index.map(function(j) { return values[j]; });
+        };
+        data[0] = Object.assign({}, data[0], range, {z: z});
+        if (data.length > 1) {
+            data[1] = Object.assign({}, data[1], range, {z: pick(z)});
+        }
+        if (frames.locations) {
+            // the map is from before a data reload, so gets the current regions
+            data[0] = Object.assign(data[0], {locations: frames.locations, customdata: frames.customdata});
+            if (data.length > 1) {
+                data[1] = Object.assign(data[1], {locations: pick(frames.locations), customdata: pick(frames.customdata)});
+            }
+        }
+        return [Object.assign({}, figure, {data: data}), frames.period_ends[i]];
+    }
+    """,
+    [
+     Output("choropleth", "figure", allow_duplicate=True),
+     Output("play_date", "children"),
+     ],
+    [
+     Input("play_interval", "n_intervals"),
+     State("map_frames", "data"),
+     State("choropleth", "figure"),
+     ],
+    prevent_initial_call=True,
+)
+
+# Record the timeseries chart width, on load and whenever plotly resizes it.
+# The first render waits for this, so it is always set on load, to the
+# default if the chart has no width yet. Later it is only set when it changes.
+app.clientside_callback(
+    """
+    function(relayoutData, current_width) {
+        var graph = document.getElementById('price-time-series');
+        var width = (graph && graph.offsetWidth) || DEFAULT_WIDTH;
+        if (width === current_width) {
+            return window.dash_clientside.no_update;
+        }
+        return width;
+    }
+    """.replace("DEFAULT_WIDTH", str(cfg["timeseries_default_width"])),
+    Output("timeseries_width", "data"),
+    [
+     Input("price-time-series", "relayoutData"),
+     State("timeseries_width", "data"),
+     ],
+)
+
+def get_xaxis_range(relayoutData):
+    """ The (start, end) of a zoomed x axis from relayoutData, or None """
+    if not relayoutData:
+        return None
+    if "xaxis.range[0]" in relayoutData:
+        return (relayoutData["xaxis.range[0]"], relayoutData["xaxis.range[1]"])
+    if "xaxis.range" in relayoutData:
+        return tuple(relayoutData["xaxis.range"])
+    return None
+
 # # Update price-time-series with postcode updates and graph-type
 @app.callback(
     Output("price-time-series", "figure"),
@@ -446,12 +838,34 @@ def update_Choropleth(variable, geo_types, duration, region_ids, period_end):
      Input('variable','value'),
      Input("duration", "value"),
      Input("period_end", "value"),
+     Input("timeseries_width", "data"),
+     Input("price-time-series", "relayoutData"),
     # Input("postcode", "value"), 
     # Input("property-type-checklist", "value")
      ],
 )
-@cache.memoize(timeout=cfg["timeout"])
-def update_price_timeseries(region_ids, variable, duration, period_end):
+@instrument_callback
+def update_price_timeseries(region_ids, variable, duration, period_end, width, relayoutData):
+    if width is None:
+        # not reported by the browser yet, and rendering now would mean
+        # rendering again as soon as it is
+        raise PreventUpdate
+    changed_id = [p["prop_id"] for p in dash.callback_context.triggered][0]
+    x_range = None
+    if changed_id == "price-time-series.relayoutData":
+        # Redraw for zooms and zoom resets only, not eg. a new drag mode.
+        x_range = get_xaxis_range(relayoutData)
+        if x_range is None and not (relayoutData or {}).get("xaxis.autorange"):
+            raise PreventUpdate
+    elif changed_id == "timeseries_width.data":
+        x_range = get_xaxis_range(relayoutData)
+    # any other change is a new selection, which starts zoomed out
+    
+    n_points = width // cfg["timeseries_px_per_point"]
+    return get_price_timeseries_figure(region_ids, variable, duration, period_end, n_points, x_range)
+
+@cache.memoize(timeout=cfg["timeout"], make_name=versioned_name)
+def get_price_timeseries_figure(region_ids, variable, duration, period_end, n_points, x_range):
 
     if len(region_ids) == 0:
         return price_ts(empty_series, "Please select regions", colors)
@@ -462,38 +876,45 @@ def update_price_timeseries(region_ids, variable, duration, period_end):
         )
 
     # --------------------------------------------------#
-    df = get_all_data_for_region_and_var(region_ids = region_ids, variable=variable, duration=duration)
-    df = df.merge(region_id_df[['region_id','region_name']], how='left', on='region_id')
-    df['period_end'] = pd.to_datetime(df['period_end'])
-    
-    df = df.sort_values('period_end')
+    # already sorted, with datetime period_end
+    # spans are recorded against update_price_timeseries, on cache misses only
+    with span('query'):
+        df = get_region_timeseries(region_ids = region_ids, variable=variable, duration=duration)
+    with span('merge'):
+        region_names = {r: region_id_lut['counties'].get(r) or region_id_lut['metros'].get(r) for r in region_ids}
+        df['region_name'] = df['region_id'].map(region_names)
+    with span('downsample'):
+        df = downsample_timeseries(df, 'period_end', variable, 'region_id', n_points, x_range)
     
-    title = var_pretty_name_lut.get(variable)
+    with span('figure'):
+        title = var_pretty_name_lut.get(variable)
     
-    labels = {
-            'period_end' : '',
-            'region_name' : '',
-             variable : '',
-        }
+        labels = {
+                'period_end' : '',
+                'region_name' : '',
+                 variable : '',
+            }
     
-    fig = px.scatter(df, x='period_end', y=variable, color='region_name',
-                     labels = labels,
-                     title=title)
-    fig.update_traces(mode='lines+markers', hovertemplate=None)
-    fig.update_layout(hovermode="x unified", hoverlabel_bgcolor='#4c535c')
-    fig.add_vline(x=pd.to_datetime(period_end), 
-                  line_width=3, 
-                  line_dash="dash", 
-                  line_color="white", 
-                  #annotation_text="Map data date", 
-                  #annotation_position="top right",
-                  )
-    fig.update_xaxes(showgrid=False)
-    fig.update_layout(margin={'l': 20, 'b': 30, 'r': 10, 't': 60},
-                      plot_bgcolor=colors['background'],
-                      paper_bgcolor=colors['background'],
-                      autosize=True,
-                      font_color=colors['text'])
+        fig = px.scatter(df, x='period_end', y=variable, color='region_name',
+                         labels = labels,
+                         title=title)
+        fig.update_traces(mode='lines+markers', hovertemplate=None)
+        fig.update_layout(hovermode="x unified", hoverlabel_bgcolor='#4c535c')
+        # keep the user's zoom when only the downsampling changes
+        fig.update_layout(uirevision=f"{region_ids}{variable}{duration}")
+        fig.add_vline(x=pd.to_datetime(period_end), 
+                      line_width=3, 
+                      line_dash="dash", 
+                      line_color="white", 
+                      #annotation_text="Map data date", 
+                      #annotation_position="top right",
+                      )
+        fig.update_xaxes(showgrid=False)
+        fig.update_layout(margin={'l': 20, 'b': 30, 'r': 10, 't': 60},
+                          plot_bgcolor=colors['background'],
+                          paper_bgcolor=colors['background'],
+                          autosize=True,
+                          font_color=colors['text'])
     
     return fig
     
@@ -533,6 +954,7 @@ def update_price_timeseries(region_ids, variable, duration, period_end):
         State("choropleth", "clickData"),
     ],
 )
+@instrument_callback
 def update_postcode_dropdown(
     clickData, selectedData, geo_type, region_ids, clickData_state
 ):
@@ -582,5 +1004,5 @@ if __name__ == "__main__":
 
 """ ----------------------------------------------------------------------------
 Terminal cmd to run:
-gunicorn app:server -b 0.0.0.0:8050
+gunicorn -c gunicorn.conf.py app:server -b 0.0.0.0:8050
 ---------------------------------------------------------------------------- """
@@ -0,0 +1,221 @@
+"""
+Latency benchmarks for the data access and figure building used by the app.
+
+Run against the current database in config, eg.
+    python benchmarks.py map_query --n 200
+"""
+import argparse
+import os
+import random
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import plotly.graph_objs as go
+import plotly.io as pio
+
+from config import config as cfg
+from figures_utils import downsample_timeseries, get_choropleth_args, get_figure, get_figure_patch
+from response_encoding import compress, orjson, brotli
+from utils import (
+    date_to_day,
+    db_connection,
+    duration_code,
+    get_all_data_for_timeperiod_and_var,
+    get_variable_info,
+    get_timeperiod_info,
+)
+
+
+def time_calls(f, args_list):
+    """ Call f(*args) for every entry in args_list, returning latencies in ms """
+    latencies = []
+    for args in args_list:
+        t0 = time.perf_counter()
+        f(*args)
+        latencies.append((time.perf_counter() - t0) * 1000)
+    return np.array(latencies)
+
+
+def summarize(name, latencies):
+    p50, p99 = np.percentile(latencies, [50, 99])
+    print(f'{name:<40} n={len(latencies):<6} p50={p50:8.2f} ms  p99={p99:8.2f} ms')
+
+
+#---------------------------------------------
+# map data, ie. get_all_data_for_timeperiod_and_var
+
+def legacy_map_query(variable, period_end, duration):
+    # The same data from weekly_data_raw, which is keyed on region first
+    q = f"""
+    SELECT region_id, period_end, duration, {variable}
+    FROM weekly_data_raw
+    WHERE period_end = {date_to_day(period_end)}
+    AND duration = {duration_code(duration)};
+    """
+    with db_connection() as con:
+        return pd.read_sql(q, con)
+
+
+def random_map_queries(n, seed=0):
+    rng = random.Random(seed)
+    variables = get_variable_info().variable.tolist()
+    periods = get_timeperiod_info()[['period_end', 'duration']].values.tolist()
+    return [(rng.choice(variables), *rng.choice(periods)) for _ in range(n)]
+
+
+def bench_map_query(n):
+    queries = random_map_queries(n)
+    # warm the OS page cache for both tables so neither is penalized by going first
+    time_calls(legacy_map_query, queries[:10])
+    time_calls(get_all_data_for_timeperiod_and_var, queries[:10])
+
+    summarize('weekly_data_raw (legacy)', time_calls(legacy_map_query, queries))
+    summarize('map_snapshot', time_calls(get_all_data_for_timeperiod_and_var, queries))
+
+
+#---------------------------------------------
+# hover text for the choropleth in update_Choropleth. Both build and serialize
+# the map trace, since the formatting moved from here to the browser
+
+def synthetic_map_df(n_regions=3500, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'region_id'   : np.arange(n_regions),
+        'region_name' : [f'Region {i} County, ST' for i in range(n_regions)],
+        'Price'       : rng.lognormal(12, 0.5, n_regions),
+        })
+
+
+def legacy_hover_text(df, label):
+    # The original per region python formatting
+    def format_hover_text(i):
+        return '{name}<br>{variable}: {value}'.format(name=i.region_name, variable=label, value=round(i['Price'], 2))
+    return df.apply(format_hover_text, axis=1)
+
+
+def legacy_hover_trace(df, label):
+    # The map trace as it was, with a hover string per region, serialized
+    trace = go.Choroplethmapbox(locations=df['region_id'], z=df['Price'],
+                                text=legacy_hover_text(df, label), hoverinfo='text')
+    return encode_json(trace, None)
+
+
+def template_hover_trace(df, label):
+    # What get_figure now does, region names as customdata and values 
+    # formatted in the browser by the hovertemplate, serialized
+    arg = get_choropleth_args(df, 'Price', label)
+    trace = go.Choroplethmapbox(locations=arg['locations'], z=arg['z_vec'],
+                                customdata=arg['customdata'], hovertemplate=arg['hovertemplate'])
+    return encode_json(trace, None)
+
+
+def bench_hover_text(n):
+    df = synthetic_map_df()
+    args = [(df, 'Median Sale Price')] * n
+
+    summarize('df.apply per region (legacy)', time_calls(legacy_hover_trace, args))
+    summarize('customdata + hovertemplate', time_calls(template_hover_trace, args))
+
+
+#---------------------------------------------
+# downsampling the timeseries chart, ie. get_price_timeseries_figure
+
+def synthetic_timeseries_df(n_regions=5, start='2012-01-01', seed=0):
+    # weekly points for every region, the full history of the chart
+    rng = np.random.default_rng(seed)
+    period_end = pd.date_range(start, pd.Timestamp.now(), freq='W')
+    return pd.DataFrame({
+        'region_id'  : np.repeat(np.arange(n_regions), len(period_end)),
+        'period_end' : np.tile(period_end, n_regions),
+        'Price'      : rng.lognormal(12, 0.1, n_regions * len(period_end)).cumsum(),
+        })
+
+
+def bench_downsample(n):
+    df = synthetic_timeseries_df()
+    print(f'{len(df)} points in total')
+    for n_points in [150, 300, 600]:
+        out = downsample_timeseries(df, 'period_end', 'Price', 'region_id', n_points)
+        summarize(f'lttb to {n_points} per region ({len(out)} points)',
+                  time_calls(downsample_timeseries, [(df, 'period_end', 'Price', 'region_id', n_points)] * n))
+
+
+#---------------------------------------------
+# encoding callback responses, see response_encoding.py
+
+def encode_json(obj, engine):
+    if hasattr(obj, 'to_plotly_json'):
+        obj = obj.to_plotly_json()
+    return pio.json.to_json_plotly(obj, engine=engine).encode()
+
+
+def map_payloads():
+    # What update_Choropleth sends, a full figure or a patch of new values
+    df = synthetic_map_df()
+    highlight_ids = df['region_id'][:5].tolist()
+    geo_url = '/assets/geodata_all.json'
+    payloads = {
+        'full figure': get_figure(df, geo_url, 'all', 'Price', None, geo_url, [], None,
+                                  hover_label='Median Sale Price', highlight_ids=highlight_ids),
+        }
+    typed_arrays = cfg['typed_arrays']
+    for name, typed in [('patch, list z', False), ('patch, typed z', True)]:
+        cfg['typed_arrays'] = typed
+        payloads[name] = get_figure_patch(df, 'Price', 'Median Sale Price', highlight_ids)
+    cfg['typed_arrays'] = typed_arrays
+    return payloads
+
+
+def bench_encode(n):
+    engines = ['json', 'orjson'] if orjson is not None else ['json']
+    encodings = ['gzip', 'br'] if brotli is not None else ['gzip']
+    for name, payload in map_payloads().items():
+        for engine in engines:
+            data = encode_json(payload, engine)
+            summarize(f'{name}, {engine} ({len(data)/1024:.0f} KB)', time_calls(encode_json, [(payload, engine)] * n))
+        for encoding in encodings:
+            compressed = compress(data, encoding)
+            summarize(f'{name}, {encoding} ({len(compressed)/1024:.0f} KB)', time_calls(compress, [(data, encoding)] * n))
+
+
+#---------------------------------------------
+# app startup, ie. a fresh gunicorn worker importing app.py
+
+def time_app_import(startup_mode):
+    env = dict(os.environ, APP_STARTUP_MODE=startup_mode)
+    subprocess.run([sys.executable, '-c', 'import app'], env=env, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def bench_startup(n):
+    # Each run is a whole new interpreter, so use fewer of them
+    n = min(n, 10)
+    for startup_mode in ['db', 'lookups_file']:
+        summarize(f'import app, startup_mode={startup_mode}', time_calls(time_app_import, [(startup_mode,)] * n))
+
+
+BENCHMARKS = {
+    'map_query': bench_map_query,
+    'hover_text': bench_hover_text,
+    'downsample': bench_downsample,
+    'encode': bench_encode,
+    'startup': bench_startup,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help=f'benchmarks to run, one of {list(BENCHMARKS)}. default is all')
+    parser.add_argument('--n', type=int, default=200, help='number of timed calls')
+    args = parser.parse_args()
+
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f'unknown benchmarks {sorted(unknown)}')
+
+    for name in args.benchmarks or BENCHMARKS:
+        print(f'--- {name}')
+        BENCHMARKS[name](args.n)
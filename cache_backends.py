@@ -0,0 +1,293 @@
+"""
+Flask-Caching backends shared by all workers, selected with config cache_backend.
+
+    sqlite  - one sqlite file on the host, eg. on /dev/shm to keep it in memory.
+              Payloads are compressed and the total size is bounded by
+              cache_max_MB, evicting least recently used entries first.
+    redis   - a redis server, or anything speaking the protocol, with the
+              same compression. Size is bounded by the server's maxmemory.
+
+Each is given to Flask-Caching as CACHE_TYPE 'cache_backends.sqlite_cache' or
+'cache_backends.redis_cache', see get_cache_config.
+"""
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+from flask_caching.backends.base import BaseCache
+from flask_caching.backends.rediscache import RedisCache
+
+# Payloads at least this size are compressed, smaller ones are not worth it
+COMPRESS_MIN_BYTES = 1024
+COMPRESS_LEVEL = 1
+
+_RAW = b'p'
+_ZLIB = b'z'
+
+# Connections inherited from a parent process, kept referenced as in 
+# utils._inherited_db_pools, since closing them here would also release the 
+# parent's sqlite locks on the file.
+_inherited_connections = []
+
+
+def dump_payload(value):
+    """ Pickle value, compressing it if large enough. Returns bytes with a 1 byte format prefix """
+    payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    if len(payload) >= COMPRESS_MIN_BYTES:
+        return _ZLIB + zlib.compress(payload, COMPRESS_LEVEL)
+    return _RAW + payload
+
+
+def load_payload(data):
+    data = bytes(data)
+    if data[:1] == _ZLIB:
+        return pickle.loads(zlib.decompress(data[1:]))
+    return pickle.loads(data[1:])
+
+
+class SQLiteCache(BaseCache):
+    """
+    Cache in a sqlite file shared by every process on the host.
+
+    Each entry records the bytes of its stored payload, and a running total
+    is kept in cache_info. When a set takes it over max_bytes, expired and
+    then least recently used entries are removed until it is within it.
+
+    Reads do not write. Access times of hits are held in memory and written
+    in one batch at most every ACCESS_FLUSH_SECONDS, or on the next set, so
+    the LRU order is only that precise.
+    """
+    ACCESS_FLUSH_SECONDS = 10
+
+    def __init__(self, path, max_bytes, default_timeout=300, **kwargs):
+        # kwargs are other Flask-Caching options, eg. ignore_delete_many_errors
+        super().__init__(default_timeout=default_timeout, **kwargs)
+        self.path = str(path)
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        # {key: time} of hits not yet written to the accessed column
+        self._accessed = dict()
+        self._accessed_lock = threading.Lock()
+        self._accessed_flushed = time.time()
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with self._transaction() as con:
+            con.execute("""
+            CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                nbytes INTEGER NOT NULL,
+                expires REAL NOT NULL,
+                accessed REAL NOT NULL
+            ) WITHOUT ROWID;
+            """)
+            con.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed);')
+            con.execute('CREATE TABLE IF NOT EXISTS cache_info (name TEXT PRIMARY KEY, value INTEGER NOT NULL) WITHOUT ROWID;')
+            # the total of an existing cache file, from before cache_info was added
+            con.execute("INSERT OR IGNORE INTO cache_info SELECT 'bytes', coalesce(sum(nbytes), 0) FROM cache;")
+
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        kwargs.update(
+            path = config['CACHE_SQLITE_PATH'],
+            max_bytes = config['CACHE_MAX_BYTES'],
+            )
+        return cls(*args, **kwargs)
+
+    def _connection(self):
+        # One connection per thread, and a new one after a fork
+        con = getattr(self._local, 'con', None)
+        if con is None or self._local.pid != os.getpid():
+            if con is not None:
+                _inherited_connections.append(con)
+            con = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            con.execute('PRAGMA journal_mode=WAL;')
+            con.execute('PRAGMA synchronous=OFF;')
+            self._local.con = con
+            self._local.pid = os.getpid()
+        return con
+
+    @contextmanager
+    def _transaction(self):
+        con = self._connection()
+        con.execute('BEGIN IMMEDIATE;')
+        try:
+            yield con
+        except BaseException:
+            con.execute('ROLLBACK;')
+            raise
+        con.execute('COMMIT;')
+
+    def _expires(self, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+        # 0 means never expire, as in the other Flask-Caching backends
+        return time.time() + timeout if timeout else float('inf')
+
+    def _add_bytes(self, con, nbytes):
+        """ Add nbytes to the running total, returning the new total """
+        con.execute("UPDATE cache_info SET value = value + ? WHERE name = 'bytes';", (nbytes,))
+        return con.execute("SELECT value FROM cache_info WHERE name = 'bytes';").fetchone()[0]
+
+    def _touch(self, key, now):
+        with self._accessed_lock:
+            self._accessed[key] = now
+            if now - self._accessed_flushed < self.ACCESS_FLUSH_SECONDS:
+                return
+        with self._transaction() as con:
+            self._flush_accessed(con)
+
+    def _flush_accessed(self, con):
+        with self._accessed_lock:
+            accessed, self._accessed = self._accessed, dict()
+            self._accessed_flushed = time.time()
+        if accessed:
+            con.executemany('UPDATE cache SET accessed = ? WHERE key = ?;', [(t, k) for k, t in accessed.items()])
+
+    def get(self, key):
+        now = time.time()
+        row = self._connection().execute('SELECT value FROM cache WHERE key = ? AND expires > ?;', (key, now)).fetchone()
+        if row is None:
+            return None
+        self._touch(key, now)
+        return load_payload(row[0])
+
+    def has(self, key):
+        row = self._connection().execute('SELECT 1 FROM cache WHERE key = ? AND expires > ?;', (key, time.time())).fetchone()
+        return row is not None
+
+    def _set(self, key, value, timeout, replace):
+        data = dump_payload(value)
+        now = time.time()
+        with self._transaction() as con:
+            row = con.execute('SELECT nbytes, expires FROM cache WHERE key = ?;', (key,)).fetchone()
+            if row is not None and not replace and row[1] > now:
+                return False
+            con.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?);',
+                        (key, data, len(data), self._expires(timeout), now))
+            total = self._add_bytes(con, len(data) - (row[0] if row else 0))
+            if total > self.max_bytes:
+                self._flush_accessed(con)
+                self._evict(con, total)
+        return True
+
+    def set(self, key, value, timeout=None):
+        return self._set(key, value, timeout, replace=True)
+
+    def add(self, key, value, timeout=None):
+        return self._set(key, value, timeout, replace=False)
+
+    def delete(self, key):
+        with self._transaction() as con:
+            row = con.execute('SELECT nbytes FROM cache WHERE key = ?;', (key,)).fetchone()
+            if row is None:
+                return False
+            con.execute('DELETE FROM cache WHERE key = ?;', (key,))
+            self._add_bytes(con, -row[0])
+        return True
+
+    def clear(self):
+        with self._transaction() as con:
+            con.execute('DELETE FROM cache;')
+            con.execute("UPDATE cache_info SET value = 0 WHERE name = 'bytes';")
+        return True
+
+    def _evict(self, con, total):
+        # Expired entries first, then the oldest until the total drops to max_bytes
+        now = time.time()
+        expired = con.execute('SELECT coalesce(sum(nbytes), 0) FROM cache WHERE expires <= ?;', (now,)).fetchone()[0]
+        con.execute('DELETE FROM cache WHERE expires <= ?;', (now,))
+        total = self._add_bytes(con, -expired)
+        if total <= self.max_bytes:
+            return
+        to_remove = total - self.max_bytes
+        removed = 0
+        keys = []
+        for key, nbytes in con.execute('SELECT key, nbytes FROM cache ORDER BY accessed;'):
+            keys.append((key,))
+            removed += nbytes
+            if removed >= to_remove:
+                break
+        con.executemany('DELETE FROM cache WHERE key = ?;', keys)
+        self._add_bytes(con, -removed)
+
+    def stats(self):
+        con = self._connection()
+        entries = con.execute('SELECT count(*) FROM cache;').fetchone()[0]
+        nbytes = con.execute("SELECT value FROM cache_info WHERE name = 'bytes';").fetchone()[0]
+        return dict(entries=entries, bytes=nbytes, max_bytes=self.max_bytes)
+
+
+class CompressedRedisCache(RedisCache):
+    """
+    RedisCache with large payloads compressed as in SQLiteCache.
+
+    Connects to CACHE_REDIS_URL, or uses the client in CACHE_REDIS_CLIENT if
+    set, so a local stand-in such as fakeredis.FakeStrictRedis() works for testing.
+    """
+    _COMPRESSED = b'~'
+
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        kwargs['key_prefix'] = config.get('CACHE_KEY_PREFIX')
+        client = config.get('CACHE_REDIS_CLIENT')
+        if client is None:
+            import redis
+            client = redis.from_url(config['CACHE_REDIS_URL'])
+        return cls(client, *args, **kwargs)
+
+    def dump_object(self, value):
+        if isinstance(value, int) and not isinstance(value, bool):
+            # kept as plain ints so redis can inc/dec them
+            return super().dump_object(value)
+        data = dump_payload(value)
+        if data[:1] == _ZLIB:
+            return self._COMPRESSED + data[1:]
+        return super().dump_object(value)
+
+    def load_object(self, value):
+        if value is not None and value[:1] == self._COMPRESSED:
+            return pickle.loads(zlib.decompress(value[1:]))
+        return super().load_object(value)
+
+
+# Flask-Caching calls a factory function named by CACHE_TYPE, or the factory
+# classmethod of a backend class
+def sqlite_cache(app, config, args, kwargs):
+    return SQLiteCache.factory(app, config, args, kwargs)
+
+
+def redis_cache(app, config, args, kwargs):
+    return CompressedRedisCache.factory(app, config, args, kwargs)
+
+
+def get_cache_config(cfg):
+    """ Flask-Caching config for cfg['cache_backend'] """
+    backend = cfg['cache_backend']
+    if backend == 'sqlite':
+        return {
+            'CACHE_TYPE': 'cache_backends.sqlite_cache',
+            'CACHE_SQLITE_PATH': cfg['cache_sqlite_file'],
+            'CACHE_MAX_BYTES': cfg['cache_max_MB'] * 1024**2,
+            'CACHE_DEFAULT_TIMEOUT': cfg['timeout'],
+            }
+    elif backend == 'redis':
+        return {
+            'CACHE_TYPE': 'cache_backends.redis_cache',
+            'CACHE_REDIS_URL': cfg['cache_redis_url'],
+            'CACHE_KEY_PREFIX': 'houseprices:',
+            'CACHE_DEFAULT_TIMEOUT': cfg['timeout'],
+            }
+    elif backend == 'filesystem':
+        return {
+            'CACHE_TYPE': 'FileSystemCache',
+            'CACHE_DIR': cfg['cache dir'],
+            'CACHE_THRESHOLD': cfg['cache threshold'],
+            'CACHE_DEFAULT_TIMEOUT': cfg['timeout'],
+            }
+    else:
+        raise ValueError(f'unknown cache_backend {backend}')
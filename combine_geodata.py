@@ -1,2 +1,33 @@
 # -*- coding: utf-8 -*-
+"""
+Combine the county and metro geodata into the 'all' geodata file, and
+likewise for each zoom tier in config geodata_tiers.
 
+Metro areas are small star shapes which are not simplified, so the untiered
+metro file is used with every county tier.
+"""
+import json
+
+import geopandas as gpd
+import pandas as pd
+
+from config import config as cfg
+from utils import get_geodata_tier_file
+
+def combine(county_file, metro_file, dest_file):
+    counties = gpd.read_file(cfg['assets dir'].joinpath(county_file))
+    metros = gpd.read_file(cfg['assets dir'].joinpath(metro_file))
+
+    combined = gpd.GeoDataFrame(pd.concat([counties, metros], ignore_index=True), crs=counties.crs)
+
+    with open(cfg['assets dir'].joinpath(dest_file),'w') as f:
+        json.dump(combined.__geo_interface__, f, separators=(',', ':'))
+
+combine(cfg['geodata_files']['counties'], cfg['geodata_files']['metros'], cfg['geodata_files']['all'])
+
+for tier in cfg['geodata_tiers']:
+    combine(
+        get_geodata_tier_file('counties', tier),
+        cfg['geodata_files']['metros'],
+        get_geodata_tier_file('all', tier),
+        )
@@ -1,4 +1,5 @@
 import os
+import logging
 from pathlib import Path
 
 appDataPath = Path("/home/shawn/projects/Plotly-App-UK-houseprices/appData")
@@ -25,24 +26,124 @@ config = {
 
     "topN": 50,
 
-    "timeout": 5 * 60,  # Used in flask_caching
-    "cache threshold": 10_000,  # corresponds to ~350MB max
+    # Used in flask_caching. Cached results are keyed on the data version, 
+    # see app.versioned_name, so they never outlive the data they came from.
+    "timeout": 6 * 60 * 60,
+    "cache threshold": 10_000,  # corresponds to ~350MB max, filesystem backend only
+
+    # Flask-Caching backend shared by the workers, see cache_backends.py. 
+    # One of 'sqlite', 'redis' or 'filesystem'. The sqlite file can go on 
+    # /dev/shm to keep it in memory.
+    'cache_backend': os.environ.get('APP_CACHE_BACKEND', 'sqlite'),
+    'cache_sqlite_file': Path(cache_dir).joinpath('flask_cache.sqlite'),
+    'cache_max_MB': 350,
+    'cache_redis_url': os.environ.get('REDIS_URL', 'redis://localhost:6379/0'),
+
+    # How often each worker checks data_db for a new data version, see 
+    # app.reload_lookups_on_new_data
+    "data_version_check_seconds": 5,
+
+    # In process cache of map data, see snapshot_cache.py
+    "snapshot cache max MB": 256,
+    "snapshot cache prewarm": True,
+    # Background threads loading upcoming dates into it, and how many dates 
+    # either side of the one shown are loaded ahead.
+    "snapshot cache prefetch workers": 4,
+    "snapshot cache prefetch periods": 4,
+
+    # Play mode of the map. Values for play_frames dates are sent to the
+    # browser at once, and shown one every play_interval_ms.
+    'play_frames': 52,
+    'play_interval_ms': 300,
+
+    # Storage used by the utils query functions. One of 'sqlite', 'parquet' or 'npy'.
+    # parquet requires pyarrow. The datasets in data_dirs are written by 
+    # ingest_raw_data.py when the matching engine is set. npy is memory mapped 
+    # arrays, so all gunicorn workers share one copy in the OS page cache.
+    'data_engine': 'sqlite',
 
     'data_dirs' : {
         'weekly_data_by_region' : appDataPath.joinpath('redfin_weekly_data_by_region'),
         'weekly_data_by_date' : appDataPath.joinpath('redfin_weekly_data_by_date'),
+        'weekly_data_cube' : appDataPath.joinpath('redfin_weekly_data_cube'),
         },
     
     'data_db': appDataPath.joinpath('data.sqlite'),
+
+    # 'full' builds a new database from each redfin file and swaps it in with 
+    # a rename. 'incremental' updates only new and changed rows of data_db in place.
+    'ingest_mode': 'full',
+    # Processes used to parse the redfin file, and the size of the piece each 
+    # parses at once. 1 parses it in the main process.
+    'ingest_workers': os.cpu_count(),
+    'ingest_chunk_MB': 32,
+
+    # Read only connections to data_db, see utils.db_connection. 
+    # sqlite_immutable is set below from ingest_mode.
+    'sqlite_cache_mb': 64,
+    'sqlite_mmap_mb': 1024,
     
     'variable_info_file' : appDataPath.joinpath('variable_info.csv'),
 
+    # 'lookups_file' loads the region and date lookups app.py needs from a 
+    # single pickle written by ingest_raw_data.py. 'db' queries data_db for them.
+    'startup_mode': os.environ.get('APP_STARTUP_MODE', 'lookups_file'),
+    'lookups_file': appDataPath.joinpath('app_lookups.pkl'),
+
+    # Vector tile pyramids of region geometry, written by preprocess_county_shapes.py 
+    # and process_metro_locations.py and served at /tiles/<geo_type>/<z>/<x>/<y>.pbf.
+    # If outlines are on the map draws region borders from the tiles, so only 
+    # visible geometry is fetched and the low geodata tier is enough for the fill.
+    'vector_tile_files' : {
+        'counties' : appDataPath.joinpath('tiles_counties.mbtiles'),
+        'metros'   : appDataPath.joinpath('tiles_metros.mbtiles'),
+        },
+    'vector_tile_zooms' : (2, 10),
+    'vector_tile_outlines' : False,
+
+    # 'full' rebuilds the choropleth figure on every update, with the geometry
+    # of highlighted regions cut from an index of the current tier's geodata.
+    # 'patch' sends the geometry once, by url, and later updates only send 
+    # the new values. Highlights are then drawn from the same url.
+    'map_update_mode': 'patch',
+
+    # Responses over this size are sent brotli or gzip compressed, and figures
+    # are serialized with orjson if installed, see response_encoding.py. 
+    # typed_arrays sends map values in patches as base64 float32 arrays, which
+    # needs plotly.js 2.28 or later, ie. dash 2.15 or later.
+    'response_compress_min_bytes': 1024,
+    'typed_arrays': True,
+
+    # Callback latency histograms at /metrics, see instrumentation.py
+    'instrumentation': os.environ.get('APP_INSTRUMENTATION', '1') == '1',
+
+    # Map colours span the 5th to 95th percentile of the values, precomputed
+    # in ingest_raw_data.py. 'period' uses those of the date shown, 'global'
+    # those over all dates so colours are comparable while changing dates.
+    'map_colour_range': 'period',
+
+    # The timeseries chart is downsampled to about one point per this many 
+    # pixels of its width, see figures_utils.downsample_timeseries. The default 
+    # width is used if the chart has not been laid out when the page loads.
+    'timeseries_px_per_point': 2,
+    'timeseries_default_width': 600,
+
     'geodata_files' : {
         'counties' : 'geodata_counties.json',
         'metros'   : 'geodata_metros.json',
         'all'      : 'geodata_all.json',
         },
 
+    # Simplified versions of each geodata file, written as eg. geodata_counties_low.json 
+    # by preprocess_county_shapes.py and combine_geodata.py. The map uses the 
+    # most detailed tier whose min_zoom is at or below the current zoom. 
+    # tolerance is for GeoSeries.simplify and precision the decimal places kept.
+    'geodata_tiers' : {
+        'low'    : {'min_zoom': 0,   'tolerance': 0.05,  'precision': 2},
+        'medium' : {'min_zoom': 5.5, 'tolerance': 0.01,  'precision': 2},
+        'high'   : {'min_zoom': 7.5, 'tolerance': 0.002, 'precision': 3},
+        },
+
     "regions_lookup": {
         'North East'      : 'North England',
         'North West'      : 'North England',
@@ -73,3 +174,13 @@ config = {
 }
 
 config['Years'] = list(range(config['start_year'], config['end_year']+1))
+
+# ingest_raw_data.py runs from cron, so logs to a file
+logging_config = {
+    'log_file': Path(app_data_dir).joinpath('ingest.log'),
+    'format_args': {'format': config['logging format'], 'level': logging.INFO},
+}
+
+# immutable connections are only safe when the live database file is never 
+# modified, ie. new ones are swapped in with a rename.
+config['sqlite_immutable'] = config['ingest_mode'] == 'full'
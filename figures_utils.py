@@ -3,8 +3,11 @@ import pandas as pd
 import plotly.graph_objs as go
 import plotly.express as px
 
+from dash import Patch
+
 from plotly.subplots import make_subplots
 from config import config as cfg
+from response_encoding import typed_array
 
 def get_scattergeo(df):
     fig = go.Figure()
@@ -23,7 +26,16 @@ def get_scattergeo(df):
     return fig
 
 
-def get_Choropleth(df, geo_data, arg, marker_opacity,
+def hover_template(label):
+    """ 
+    Hover label of region name and value. The names are sent once as customdata
+    and the values are formatted by plotly.js in the browser, so no per region
+    strings are built in python. 
+    """
+    return '%{customdata}<br>' + label + ': %{z:.2~f}<extra></extra>'
+
+
+def get_Choropleth(geo_data, arg, marker_opacity,
                    marker_line_width, marker_line_color, fig=None):
 
     if fig is None:
@@ -32,14 +44,14 @@ def get_Choropleth(df, geo_data, arg, marker_opacity,
     fig.add_trace(
             go.Choroplethmapbox(
                 geojson = geo_data,
-                locations = df['region_id'],
+                locations = arg['locations'],
                 featureidkey = "properties.region_id",
                 colorscale = arg['colorscale'],
                 z = arg['z_vec'],
                 zmin = arg['min_value'],
                 zmax = arg['max_value'],
-                text = arg['text_vec'],
-                hoverinfo="text",
+                customdata = arg['customdata'],
+                hovertemplate = arg['hovertemplate'],
                 marker_opacity = marker_opacity,
                 marker_line_width = marker_line_width,
                 marker_line_color = marker_line_color,
@@ -49,42 +61,83 @@ def get_Choropleth(df, geo_data, arg, marker_opacity,
     return fig
 
 
-def get_figure(df, geo_data, region, gtype, year, geo_sectors, school, schools_top_500):
-    """ ref: https://plotly.com/python/builtin-colorscales/
+def get_outline_layers(tile_urls):
+    """ 
+    mapbox line layers of region borders from vector tiles, 
+    tile_urls is {layer_name: 'http://.../{z}/{x}/{y}.pbf'} 
     """
-    config = {'doubleClickDelay': 1000} #Set a high delay to make double click easier
+    return [
+        dict(sourcetype='vector', source=[url], sourcelayer=layer_name,
+             type='line', color='#6666cc', line_width=1, below='traces')
+        for layer_name, url in tile_urls.items()
+    ]
 
-    _cfg = cfg['plotly_config'][region]
 
+def get_choropleth_args(df, gtype, hover_label='', value_range=None):
+    """ value_range is (min, max) of the colour scale, by default quantiles of df """
     arg = dict()
+    arg['locations'] = df['region_id']
+    arg['customdata'] = df['region_name']
+    arg['hovertemplate'] = hover_template(hover_label)
     if gtype == 'Price':
-        arg['min_value'] = df['Price'].quantile(0.05)
-        arg['max_value'] = df['Price'].quantile(0.95)
-        arg['z_vec'] = df['Price']
-        arg['text_vec'] = df['text']
+        column, quantiles = 'Price', (0.05, 0.95)
+        # float32 is what the data is stored as, and half the bytes of float64 as a typed array
+        arg['z_vec'] = df['Price'].astype('float32')
         arg['colorscale'] = "YlOrRd"
         arg['title'] = ""
 
     elif gtype == 'Volume':
-        arg['min_value'] = np.percentile(np.array(df.Volume), 5)
-        arg['max_value'] = np.percentile(np.array(df.Volume), 95)
+        column, quantiles = 'Volume', (0.05, 0.95)
         arg['z_vec'] = df['Volume']
-        arg['text_vec'] = df['text']
         arg['colorscale'] = "Plasma"
         arg['title'] = "Sales Volume"
 
     else:
-        arg['min_value'] = np.percentile(np.array(df['Percentage Change']), 10)
-        arg['max_value'] = np.percentile(np.array(df['Percentage Change']), 90)
+        column, quantiles = 'Percentage Change', (0.1, 0.9)
         arg['z_vec'] = df['Percentage Change']
-        arg['text_vec'] = df['text']
         arg['colorscale'] = "Picnic"
         arg['title'] = "Avg. Price %Change"
 
+    # the quantiles are only needed without a precomputed range
+    if value_range is None:
+        value_range = df[column].quantile(quantiles)
+    arg['min_value'], arg['max_value'] = value_range
+
+    return arg
+
+
+def subset_choropleth_args(arg, mask):
+    """ arg from get_choropleth_args for only the regions in the boolean mask """
+    arg = arg.copy()
+    for k in ['locations', 'z_vec', 'customdata']:
+        arg[k] = arg[k][mask]
+    return arg
+
+
+def get_figure(df, geo_data, region, gtype, year, geo_sectors, school, schools_top_500,
+               hover_label='', highlight_ids=None, outline_tiles=None, value_range=None):
+    """ ref: https://plotly.com/python/builtin-colorscales/
+
+    geo_sectors is the geojson for the highlighted regions. If highlight_ids is
+    set it can instead be the full geojson url, and only the highlight_ids
+    regions are drawn from it.
+
+    If outline_tiles is set, see get_outline_layers, region borders are drawn
+    from vector tiles instead of from geo_data.
+
+    value_range is the (min, max) of the colour scale, see get_choropleth_args.
+    """
+    config = {'doubleClickDelay': 1000} #Set a high delay to make double click easier
+
+    _cfg = cfg['plotly_config'][region]
+
+    arg = get_choropleth_args(df, gtype, hover_label, value_range)
+
     #-------------------------------------------#
     # Main Choropleth:
-    fig = get_Choropleth(df, geo_data, arg, marker_opacity=0.4,
-                         marker_line_width=1, marker_line_color='#6666cc')
+    fig = get_Choropleth(geo_data, arg, marker_opacity=0.4,
+                         marker_line_width=0 if outline_tiles else 1, 
+                         marker_line_color='#6666cc')
 
     #-------------------------------------------#
     # School scatter_geo plot
@@ -113,16 +166,46 @@ def get_figure(df, geo_data, region, gtype, year, geo_sectors, school, schools_t
                       uirevision=region,
                       margin={"r":0,"t":0,"l":0,"b":0}
                      )
+    if outline_tiles:
+        fig.update_layout(mapbox_layers=get_outline_layers(outline_tiles))
 
     #-------------------------------------------#
     # Highlight selections:
     if geo_sectors is not None and len(school)==0:
-        fig = get_Choropleth(df, geo_sectors, arg, marker_opacity=1.0,
+        if highlight_ids is not None:
+            arg = subset_choropleth_args(arg, df['region_id'].isin(highlight_ids))
+        fig = get_Choropleth(geo_sectors, arg, marker_opacity=1.0,
                              marker_line_width=3, marker_line_color='aqua', fig=fig)
 
     return fig
 
 
+def get_figure_patch(df, gtype, hover_label, highlight_ids, value_range=None):
+    """
+    Partial update for a figure made with get_figure(..., highlight_ids=...).
+
+    df must have the same regions in the same order as the original figure.
+    Then the geometry, locations and region names are already in the browser
+    and only the values, colour range, and the small highlight trace are sent.
+    With config typed_arrays the values are sent as base64 float32.
+    """
+    arg = get_choropleth_args(df, gtype, hover_label, value_range)
+    highlight_arg = subset_choropleth_args(arg, df['region_id'].isin(highlight_ids))
+
+    patch = Patch()
+    for i, trace_arg in enumerate([arg, highlight_arg]):
+        z = trace_arg['z_vec']
+        patch['data'][i]['z'] = typed_array(z) if cfg['typed_arrays'] else z
+        patch['data'][i]['zmin'] = trace_arg['min_value']
+        patch['data'][i]['zmax'] = trace_arg['max_value']
+        patch['data'][i]['hovertemplate'] = trace_arg['hovertemplate']
+
+    patch['data'][1]['locations'] = highlight_arg['locations']
+    patch['data'][1]['customdata'] = highlight_arg['customdata']
+
+    return patch
+
+
 def price_volume_ts(price, volume, sector, colors):
 
     fig = make_subplots(specs=[[{"secondary_y": True}]])
@@ -169,6 +252,73 @@ def price_volume_ts(price, volume, sector, colors):
     return fig
 
 
+def lttb_indices(x, y, n_out):
+    """
+    Indices of the n_out points kept by Largest-Triangle-Three-Buckets 
+    downsampling of x, y, with x sorted. The first and last points are always
+    kept, and in between one point per bucket, the one making the largest 
+    triangle with the previous kept point and the mean of the next bucket.
+    
+    Bucket edges and means are computed for all buckets at once. Only the 
+    choice within each bucket is a loop, since it depends on the previous one.
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    
+    # n_out - 2 buckets over the points between the first and last
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    x_cumsum = np.r_[0, np.cumsum(x)]
+    y_cumsum = np.r_[0, np.cumsum(y)]
+    counts = np.diff(edges)
+    # mean of the bucket after each one, the last point for the final bucket
+    next_x = np.r_[(x_cumsum[edges[2:]] - x_cumsum[edges[1:-1]]) / counts[1:], x[-1]]
+    next_y = np.r_[(y_cumsum[edges[2:]] - y_cumsum[edges[1:-1]]) / counts[1:], y[-1]]
+    
+    keep = np.empty(n_out, dtype=int)
+    keep[0], keep[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # twice the triangle areas, the factor does not change the argmax
+        areas = np.abs((x[a] - next_x[i]) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (next_y[i] - y[a]))
+        a = lo + areas.argmax()
+        keep[i + 1] = a
+    return keep
+
+
+def downsample_timeseries(df, x_col, y_col, group_col, n_points, x_range=None):
+    """
+    Downsample each group_col series of df to about n_points with lttb_indices. 
+    df is sorted on x_col within each group.
+    
+    If x_range is given only the points within it are kept, along with one 
+    either side so lines reach the plot edges. When zoomed in far enough that 
+    is n_points or less, and the series is sent at full resolution.
+    """
+    parts = []
+    for _, series in df.groupby(group_col, sort=False):
+        if x_range is not None:
+            x = series[x_col].to_numpy()
+            lo = max(np.searchsorted(x, pd.Timestamp(x_range[0]).to_datetime64(), side='left') - 1, 0)
+            hi = np.searchsorted(x, pd.Timestamp(x_range[1]).to_datetime64(), side='right') + 1
+            series = series.iloc[lo:hi]
+        
+        if len(series) > n_points:
+            # missing values would only be drawn as gaps, which downsampling loses anyway
+            series = series[series[y_col].notna()]
+            x = series[x_col].to_numpy().astype('datetime64[D]').astype(float)
+            series = series.iloc[lttb_indices(x, series[y_col].to_numpy(), n_points)]
+        parts.append(series)
+    
+    if not parts:
+        return df
+    return pd.concat(parts, ignore_index=True)
+
+
 def price_ts(df, title, colors):
     fig = px.scatter(df, labels=dict(value="Average Price (£)", variable="PostCodes"),
                      title=title)
@@ -0,0 +1,36 @@
+"""
+gunicorn settings for running with a preloaded app, eg.
+    gunicorn -c gunicorn.conf.py app:server
+
+app.py is imported once in the master process, and workers are forked from
+it. Read only data loaded at import (lookups, the prewarmed snapshot cache,
+the geojson feature indexes) is then shared copy-on-write between workers
+instead of every worker loading its own copy.
+"""
+import gc
+
+from config import config as cfg
+
+preload_app = True
+
+
+def when_ready(server):
+    # Runs in the master after app.py has been imported, before any workers.
+    if cfg['map_update_mode'] == 'full':
+        # Otherwise loaded on the first highlight in each worker
+        from utils import get_geo_feature_index
+        for geo_type in cfg['geodata_files']:
+            for tier in cfg['geodata_tiers']:
+                get_geo_feature_index(geo_type, tier)
+
+    # Move everything loaded so far out of the garbage collector's reach.
+    # Collections in workers would otherwise write to every object header,
+    # copying most of the shared pages.
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    # sqlite connections must not be used or closed across a fork, so the
+    # master's are set aside untouched and each worker opens its own on first use.
+    from utils import reset_db_connections
+    reset_db_connections()
@@ -1,192 +1,914 @@
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
+import gzip
+import io
+import os
+import numpy as np
 import pandas as pd
 import sqlite3
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 
 from config import config as cfg
 from config import logging_config
 
-from utils import get_variable_info
+from utils import get_variable_info, date_to_day, duration_code, write_app_lookups_file
 
 from pathlib import Path
-from itertools import takewhile, repeat, product
 
 import logging
 logging.basicConfig(filename=logging_config['log_file'], **logging_config['format_args'])
 
-def linecount(filename):
-    # Line count on a text file. Efficient for larger than mem files.
-    # from https://stackoverflow.com/a/27518377
-    f = open(filename, 'rb')
-    bufgen = takewhile(lambda x: x, (f.raw.read(1024*1024) for _ in repeat(None)))
-    return sum(buf.count(b'\n') for buf in bufgen)
+import shutil
+import requests
 
+import hashlib
+import time
 
-def expand_grid(dictionary):
-   return pd.DataFrame([row for row in product(*dictionary.values())], 
-                       columns=dictionary.keys())
+MB = 1024**2
 
-import shutil
-import requests
+READ_CHUNKSIZE = 50000
 
-def download_file(url, local_path = None):
-    """ 
-    Download a file.
+GZIP_MAGIC = b'\x1f\x8b'
+
+class HashingReader(io.RawIOBase):
+    """
+    Read only wrapper of a binary stream which md5 hashes and counts every 
+    byte read through it, and copies them to tee_file if given.
+    """
+    def __init__(self, raw, tee_file=None):
+        self.raw = raw
+        self.tee_file = tee_file
+        self.md5 = hashlib.md5()
+        self.n_bytes = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.raw.read(len(b))
+        n = len(data)
+        b[:n] = data
+        self.md5.update(data)
+        self.n_bytes += n
+        if self.tee_file is not None:
+            self.tee_file.write(data)
+        return n
+
+    def drain(self):
+        """ Read, and so hash and copy, anything left in the stream """
+        buffer = bytearray(MB)
+        while self.readinto(buffer):
+            pass
+
+class RedfinDownload:
+    """
+    Stream the redfin file at url, so it is parsed while it downloads. 
     
-    If local_path is none the file is downloaded to the current directory.
-    If a folder the file is downloaded there with the same filename as the url.
-    If a file the file is downloaded to that name. 
+    Used as a context manager, stream is then the file as a binary stream, 
+    decompressed on the fly if gzipped. The bytes as downloaded are hashed 
+    and copied to archive_file as they arrive, so the file is read once. 
+    Anything not read by the parser is read by finish(), or on exit, so md5 
+    and the archive always cover the whole file.
     
-    Returns the downloaded file path
+    etag and last_modified from the previous download make it a conditional 
+    request. If the server answers that the file is unchanged then 
+    not_modified is True and nothing is downloaded. 
+    
+    Any http server can stand in for redfin, eg. python -m http.server in a 
+    directory with a test file, which also answers If-Modified-Since.
     """
-    if local_path is None:
-        local_path = '.'
+    def __init__(self, url, archive_file, etag=None, last_modified=None):
+        self.url = url
+        self.archive_file = Path(archive_file)
+        self.request_headers = {}
+        if etag:
+            self.request_headers['If-None-Match'] = etag
+        if last_modified:
+            self.request_headers['If-Modified-Since'] = last_modified
+
+    def __enter__(self):
+        self.response = requests.get(self.url, headers=self.request_headers, stream=True, timeout=60)
+        self.not_modified = self.response.status_code == 304
+        if self.not_modified:
+            return self
+        self.response.raise_for_status()
         
-    local_path = Path(local_path)
-    if local_path.is_file():
-        pass
-    elif local_path.is_dir():
-        pass
-        local_filename = url.split('/')[-1]
-        local_path = local_path.joinpath(local_filename)
+        self.etag = self.response.headers.get('ETag')
+        self.last_modified = self.response.headers.get('Last-Modified')
         
-    #path = os.path.join("/{}/{}".format(folder_name, local_filename))
-    with requests.get(url, stream=True) as r:
-        with open(local_path, 'wb') as f:
-            shutil.copyfileobj(r.raw, f)
+        self._archive = open(self.archive_file, 'wb')
+        self.source = HashingReader(self.response.raw, tee_file=self._archive)
+        buffered = io.BufferedReader(self.source, buffer_size=MB)
+        self.compressed = buffered.peek(2)[:2] == GZIP_MAGIC
+        self.stream = gzip.GzipFile(fileobj=buffered) if self.compressed else buffered
+        return self
 
-    return local_path
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.not_modified:
+            if exc_type is None:
+                self.finish()
+            self._archive.close()
+        self.response.close()
 
-import hashlib
+    def finish(self):
+        """ Read the rest of the file, and return its md5. Safe to call again. """
+        self.source.drain()
+        return self.md5
 
-MB = 1024**2
+    @property
+    def md5(self):
+        return self.source.md5.hexdigest()
+
+class FileUnchanged(Exception):
+    """ The downloaded file is the same as the one already ingested """
+
+def get_column_dtypes(columns, variables):
+    """ 
+    Explicit dtypes for every column of the redfin file, so pandas does no 
+    type inference. Variables are floats, region_id an int, and everything
+    else is kept as text.
+    """
+    variables = set(variables)
+    dtypes = dict()
+    for col in columns:
+        if col in variables:
+            dtypes[col] = 'float64'
+        elif col == 'region_id':
+            dtypes[col] = 'int64'
+        else:
+            dtypes[col] = 'object'
+    return dtypes
+
+# Primary key of weekly_data_raw, which is also the lookup order of 
+# get_all_data_for_region_and_var
+WEEKLY_KEY_COLUMNS = ['duration', 'region_id', 'period_end']
+# Primary key of map_snapshot, the lookup order of get_all_data_for_timeperiod_and_var
+SNAPSHOT_KEY_COLUMNS = ['duration', 'period_end', 'region_id']
 
-def getmd5(filepath):
-    md5 = hashlib.md5()
+def create_weekly_table(con, table, key_columns, variables):
+    """ 
+    Create a table with the compact schema of weekly_data_raw. Dates are
+    day numbers and durations small integers, see utils.date_to_day and 
+    utils.duration_code. Region names and types are only in region_info.
+
+    The table is clustered on key_columns, or with key_columns None it is a
+    plain rowid table, for appending rows in any order.
+    """
+    var_defs = ', '.join([f'{v} REAL' for v in variables])
+    if key_columns is None:
+        q = f"create table {table} (duration INTEGER, region_id INTEGER, period_end INTEGER, {var_defs})"
+    else:
+        q = f"""
+        create table {table} (
+            duration INTEGER,
+            region_id INTEGER,
+            period_end INTEGER,
+            {var_defs},
+            PRIMARY KEY ({', '.join(key_columns)})
+        ) WITHOUT ROWID
+        """
+    con.execute(q)
+
+def region_names(file_chunk):
+    """ {(region_type, region_id): region_name} of file_chunk, skipping missing names """
+    regions = file_chunk[['region_type', 'region_id', 'region_name']].dropna(subset=['region_name'])
+    return {(t, i): n for t, i, n in regions.itertuples(index=False, name=None)}
+
+def compact_chunk(file_chunk, variables):
+    """ Rows of the redfin file in the compact schema of create_weekly_table """
+    durations = file_chunk['duration']
+    compact = pd.DataFrame({
+        'duration'   : durations.map({d: duration_code(d) for d in durations.unique()}),
+        'region_id'  : file_chunk['region_id'],
+        'period_end' : date_to_day(file_chunk['period_end']),
+        })
+    return pd.concat([compact, file_chunk[variables]], axis=1)
+
+def read_file_columns(tsv_stream, variables):
+    """ Read the header line of tsv_stream, leaving it at the first row """
+    columns = tsv_stream.readline().decode().rstrip('\r\n').split('\t')
+    missing = set(variables) - set(columns)
+    if missing:
+        raise RuntimeError(f'variables missing from redfin file: {sorted(missing)}')
+    return columns
+
+def iter_byte_chunks(stream, chunk_bytes):
+    """ Read a binary stream in pieces of about chunk_bytes, each a complete set of lines """
+    leftover = b''
+    while True:
+        data = stream.read(chunk_bytes)
+        if not data:
+            break
+        data = leftover + data
+        cut = data.rfind(b'\n') + 1
+        leftover = data[cut:]
+        if cut:
+            yield data[:cut]
+    if leftover:
+        yield leftover
+
+def _parse_bytes(data, columns, dtypes):
+    # runs in a worker process for iter_file_chunks
+    return pd.read_csv(io.BytesIO(data), sep='\t', header=None, names=columns, dtype=dtypes)
+
+def iter_file_chunks(tsv_stream, columns, dtypes):
+    """
+    Yield the rows of tsv_stream as DataFrames, in file order. tsv_stream is
+    a binary stream just after the header line, see read_file_columns.
+
+    The stream is read in pieces of config ingest_chunk_MB, split on newlines.
+    With config ingest_workers > 1 the pieces are parsed in a process pool 
+    while the next ones are read. At most 2 pieces per worker are parsed 
+    ahead of the consumer, so memory stays bounded when writing is the
+    slower step. Otherwise they are parsed in this process.
+    """
+    n_workers = cfg['ingest_workers']
+    pieces = iter_byte_chunks(tsv_stream, cfg['ingest_chunk_MB'] * MB)
+    if n_workers <= 1:
+        for data in pieces:
+            yield _parse_bytes(data, columns, dtypes)
+        return
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        pending = deque()
+        for data in pieces:
+            pending.append(executor.submit(_parse_bytes, data, columns, dtypes))
+            if len(pending) >= 2 * n_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def load_weekly_data(tsv_stream, sqlite_file, variables):
+    """
+    Stream the redfin file into the weekly_data_raw, timeperiod_info and 
+    region_info tables of a new sqlite_file. tsv_stream is a binary stream 
+    of the file, eg. RedfinDownload.stream.
+
+    Chunks are parsed with explicit dtypes and appended with executemany to 
+    a plain rowid table, in file order. weekly_data_raw is then built from 
+    it with one sorted insert, so its clustered b-tree is written in key order 
+    rather than updated at random for every row. Rows repeating a (region,
+    period, duration) are reported, and the last one in the file is kept. 
+    
+    This is all inside a single transaction with journaling and syncing off.
+    That is safe here since sqlite_file is a temporary database which is 
+    thrown away if anything fails. 
     
-    with open(filepath, 'rb') as fo:
-        while True:
-            data = fo.read(2*MB)
-            if not data:
-                break
-            md5.update(data)
-    return md5.digest()
+    Returns the number of rows loaded and the rows/sec throughput.
+    """
+    variables = list(variables)
+    columns = read_file_columns(tsv_stream, variables)
+    dtypes = get_column_dtypes(columns, variables)
+    table_columns = ', '.join(WEEKLY_KEY_COLUMNS + variables)
+    
+    insert_q = f"insert into weekly_data_load values ({', '.join(['?'] * (len(variables) + 3))})"
 
-if __name__ == "__main__":
+    t0 = time.time()
+    n_rows = 0
+    timeperiods = set()
+    # {(region_type, region_id): region_name}, the last name in the file
+    regions = dict()
 
-    logging.info('------------BEGIN redfin data ingest---------------')
+    con = sqlite3.connect(sqlite_file, isolation_level=None)
+    con.execute('PRAGMA journal_mode = OFF;')
+    con.execute('PRAGMA synchronous = OFF;')
+    create_weekly_table(con, 'weekly_data_load', None, variables)
+    create_weekly_table(con, 'weekly_data_raw', WEEKLY_KEY_COLUMNS, variables)
     
-    file_log = pd.read_csv(cfg['redfin_file_log'])
-    current_file_info = file_log.query('current_source').iloc[0]
+    con.execute('BEGIN;')
+    for file_chunk in tqdm(iter_file_chunks(tsv_stream, columns, dtypes), unit='chunk'):
+        con.executemany(insert_q, compact_chunk(file_chunk, variables).itertuples(index=False, name=None))
+        timeperiods.update(file_chunk[['period_begin', 'period_end', 'duration']].itertuples(index=False, name=None))
+        regions.update(region_names(file_chunk))
+        n_rows += len(file_chunk)
+    
+    # ordered by rowid within each key, so a later duplicate replaces an earlier one
+    con.execute(f"""
+    insert or replace into weekly_data_raw ({table_columns})
+    SELECT {table_columns} FROM weekly_data_load
+    ORDER BY {', '.join(WEEKLY_KEY_COLUMNS)}, rowid
+    """)
+    n_unique = con.execute('select count(*) from weekly_data_raw;').fetchone()[0]
+    if n_unique < n_rows:
+        examples = con.execute(f"""
+        SELECT {', '.join(WEEKLY_KEY_COLUMNS)}, count(*) FROM weekly_data_load
+        GROUP BY {', '.join(WEEKLY_KEY_COLUMNS)} HAVING count(*) > 1 LIMIT 5
+        """).fetchall()
+        logging.warning(f'{n_rows - n_unique} rows repeat the (duration, region_id, period_end) of an earlier row '
+                        f'and replaced it, eg. {examples}')
+    con.execute('drop table weekly_data_load;')
     
-    new_raw_data_file = cfg['redfin_data_dir'].joinpath('temp.tsv')
+    # table timperiod_info for get_timeperiod_info function
+    con.execute('create table timeperiod_info (period_begin TEXT, period_end TEXT, duration TEXT);')
+    con.executemany('insert into timeperiod_info values (?, ?, ?)', sorted(timeperiods))
+    # table region_info for get_all_region_info function
+    con.execute('create table region_info (region_type TEXT, region_id INTEGER, region_name TEXT);')
+    con.executemany('insert into region_info values (?, ?, ?)', [(t, i, n) for (t, i), n in sorted(regions.items())])
     
-    logging.info('downloading latest file')
-    download_file( cfg['redfin_data_url'], local_path = new_raw_data_file)
+    # the pages of the dropped load table are reused by the tables built next
+    con.execute('COMMIT;')
+    con.close()
     
-    # Check the md5 against the most recent one, only update if new
-    newfile_md5 = getmd5(new_raw_data_file).hex()
-    if newfile_md5 == current_file_info.md5sum:
-        logging.info('latest file matches md5 of older file. quitting')
-        new_raw_data_file.unlink()
-        exit()
+    elapsed = time.time() - t0
+    rows_per_sec = n_rows / elapsed
+    logging.info(f'loaded {n_rows} rows in {elapsed:.1f} seconds, {rows_per_sec:.0f} rows/sec')
     
-    logging.info('new file has new md5. continuing ingest')
-    temp_sqlite_file = cfg['data_db'].parent.joinpath('temp.sqlite')
-    
-    # Take the hard to read giant tsv file and put into an sqlite db
-    read_chunksize = 10000
-    n_lines = linecount(new_raw_data_file)
-    n_chunks = int((n_lines/read_chunksize) + 1)
-    
-    logging.info(f'writing weekly_data_raw table with {n_lines} rows')
-    
-    with sqlite3.connect(temp_sqlite_file) as con:
-        with pd.read_csv(new_raw_data_file, sep='\t', chunksize=read_chunksize) as reader:
-            for file_chunk in tqdm(reader, total=n_chunks):
-                pass
-                #file_chunk['period_begin'] = pd.to_datetime(file_chunk['period_begin']).dt.to_pydatetime()
-                #file_chunk['period_end'] = pd.to_datetime(file_chunk['period_end']).dt.to_pydatetime()
-                file_chunk.to_sql('weekly_data_raw', con, if_exists='append')
-                
-    logging.info('creating indexes')
-    with sqlite3.connect(temp_sqlite_file) as con:
-        # index for get_all_data_for_timeperiod_and_var, which retrieves data for the map. 
-        con.execute('create index date_duration_idx on weekly_data_raw (period_end, duration);')
-        # index for get_all_data_for_region_and_var, which retrieves data for the timeseries plot
-        con.execute('create index region_id_idx on weekly_data_raw (region_id, duration);')
+    return n_rows, rows_per_sec
+
+PARQUET_ROW_GROUP_SIZE = 10000
+
+def write_parquet_dataset(sqlite_file, dest_dir, table, columns, sort_col):
+    """
+    Write one parquet file per duration, hive partitioned as dest_dir/duration=X/,
+    with rows sorted on sort_col. Row groups are kept small so the min/max 
+    statistics of sort_col let readers skip everything except the requested rows.
+
+    The dataset is written to a temporary directory and swapped in at the end.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # Explicit, rather than inferred from the first chunk, where a variable 
+    # with no values at all would come out as a null column
+    schema = pa.schema([
+        (c, pa.int32() if c in WEEKLY_KEY_COLUMNS else pa.float64()) for c in columns
+        ])
+
+    dest_dir = Path(dest_dir)
+    temp_dir = dest_dir.with_name(dest_dir.name + '_temp')
+    if temp_dir.exists():
+        shutil.rmtree(temp_dir)
+
+    col_str = ', '.join(columns)
+    with sqlite3.connect(sqlite_file) as con:
+        durations = pd.read_sql('select distinct duration from timeperiod_info', con).duration
+        for duration in durations.map(duration_code):
+            partition_dir = temp_dir.joinpath(f'duration={duration}')
+            partition_dir.mkdir(parents=True)
+
+            q = f"""
+            SELECT {col_str} FROM {table}
+            WHERE duration = {duration}
+            ORDER BY {sort_col}
+            """
+            with pq.ParquetWriter(partition_dir.joinpath('part-0.parquet'), schema) as writer:
+                for chunk in pd.read_sql(q, con, chunksize=PARQUET_ROW_GROUP_SIZE):
+                    chunk_table = pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+                    writer.write_table(chunk_table, row_group_size=PARQUET_ROW_GROUP_SIZE)
+
+    if dest_dir.exists():
+        shutil.rmtree(dest_dir)
+    temp_dir.rename(dest_dir)
+
+def write_parquet_datasets(sqlite_file, variables):
+    """ 
+    Write the parquet datasets used by the parquet data_engine in utils.py. 
+    weekly_data_by_region is sorted on region_id for get_all_data_for_region_and_var,
+    and weekly_data_by_date is sorted on period_end for get_all_data_for_timeperiod_and_var.
+    """
+    variables = list(variables)
+    write_parquet_dataset(
+        sqlite_file, 
+        dest_dir = cfg['data_dirs']['weekly_data_by_region'],
+        table    = 'weekly_data_raw',
+        columns  = ['region_id', 'period_end'] + variables,
+        sort_col = 'region_id, period_end',
+        )
+    write_parquet_dataset(
+        sqlite_file, 
+        dest_dir = cfg['data_dirs']['weekly_data_by_date'],
+        table    = 'map_snapshot',
+        columns  = ['region_id', 'period_end'] + variables,
+        sort_col = 'period_end, region_id',
+        )
+
+def write_npy_cube(sqlite_file, dest_dir, variables):
+    """
+    Write weekly_data_raw as dense arrays for the npy data_engine in utils.py.
+
+    For every variable and duration there is {variable}_{duration}.npy, a 
+    float32 array shaped [n_periods, n_regions] with NaN where there is no 
+    data. The index maps are regions.npy, the sorted int32 region_ids of the 
+    columns, and periods_{duration}.npy, the sorted int32 period_end days 
+    of the rows. Arrays are filled through memory maps, so the whole cube is 
+    never in memory here.
+    
+    The directory is written under a temporary name and swapped in at the end.
+    """
+    variables = list(variables)
+    dest_dir = Path(dest_dir)
+    temp_dir = dest_dir.with_name(dest_dir.name + '_temp')
+    if temp_dir.exists():
+        shutil.rmtree(temp_dir)
+    temp_dir.mkdir(parents=True)
+
+    with sqlite3.connect(sqlite_file) as con:
+        regions = pd.read_sql('select distinct region_id from weekly_data_raw order by region_id', con).region_id.to_numpy(dtype=np.int32)
+        np.save(temp_dir.joinpath('regions.npy'), regions)
         
-    # table timperiod_info for get_timeperiod_info function
-    with sqlite3.connect(temp_sqlite_file) as con:
-        con.execute('drop table if exists timeperiod_info;')
-        q = """
-        create table timeperiod_info as
-        SELECT DISTINCT period_begin, period_end, duration 
-        FROM weekly_data_raw
-        """
-        con.execute(q)
+        durations = pd.read_sql('select distinct duration from weekly_data_raw', con).duration
+        for duration in durations:
+            periods = pd.read_sql(f'select distinct period_end from weekly_data_raw where duration = {duration} order by period_end', con).period_end.to_numpy(dtype=np.int32)
+            np.save(temp_dir.joinpath(f'periods_{duration}.npy'), periods)
+            
+            cubes = {}
+            for v in variables:
+                cubes[v] = np.lib.format.open_memmap(temp_dir.joinpath(f'{v}_{duration}.npy'), mode='w+', 
+                                                     dtype=np.float32, shape=(len(periods), len(regions)))
+                cubes[v][:] = np.nan
+            
+            q = f"""
+            SELECT region_id, period_end, {', '.join(variables)}
+            FROM weekly_data_raw
+            WHERE duration = {duration}
+            """
+            for chunk in pd.read_sql(q, con, chunksize=READ_CHUNKSIZE):
+                rows = np.searchsorted(periods, chunk['period_end'].to_numpy())
+                cols = np.searchsorted(regions, chunk['region_id'].to_numpy())
+                for v in variables:
+                    cubes[v][rows, cols] = chunk[v].to_numpy(dtype=np.float32, na_value=np.nan)
+            
+            for cube in cubes.values():
+                cube.flush()
+            del cubes
+
+    # rename the old directory out of the way first, so there is no moment 
+    # without a complete cube in place
+    old_dir = dest_dir.with_name(dest_dir.name + '_old')
+    if old_dir.exists():
+        shutil.rmtree(old_dir)
+    if dest_dir.exists():
+        dest_dir.rename(old_dir)
+    temp_dir.rename(dest_dir)
+    if old_dir.exists():
+        shutil.rmtree(old_dir)
+
+def build_database(tsv_stream, sqlite_file, variables, after_load=None):
+    """
+    Build a complete new database from tsv_stream, with all tables used by utils.py.
     
-    # table region_info for get_all_region_info function
-    with sqlite3.connect(temp_sqlite_file) as con:
-        con.execute('drop table if exists region_info;')
-        q = """
-        create table region_info as
-        SELECT DISTINCT region_type, region_id, region_name
+    after_load(), eg. a check that the file is new, is called once the file 
+    has been loaded and before the other tables are built from it. If it 
+    raises nothing more is built.
+    
+    Returns the number of rows loaded and the rows/sec throughput.
+    """
+    logging.info('writing weekly_data_raw, timeperiod_info, and region_info tables')
+    n_rows, rows_per_sec = load_weekly_data(tsv_stream, sqlite_file, variables)
+    
+    if after_load is not None:
+        after_load()
+    
+    # table map_snapshot for get_all_data_for_timeperiod_and_var
+    logging.info('creating map_snapshot table')
+    build_map_snapshot_table(sqlite_file, variables)
+    
+    logging.info('creating region_timeseries table')
+    build_region_timeseries_table(sqlite_file, variables)
+    
+    logging.info('creating snapshot_stats and global_stats tables')
+    build_snapshot_stats_tables(sqlite_file, variables)
+    
+    return n_rows, rows_per_sec
+
+def _upsert_query(table, columns, key_columns):
+    """ 
+    Insert rows, or update existing rows with the same key, but only when 
+    at least one value differs so unchanged rows are not rewritten.
+    """
+    value_columns = [c for c in columns if c not in key_columns]
+    updates = ', '.join([f'{c} = excluded.{c}' for c in value_columns])
+    differs = ' OR '.join([f'{table}.{c} IS NOT excluded.{c}' for c in value_columns])
+    return f"""
+    INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['?'] * len(columns))})
+    ON CONFLICT ({', '.join(key_columns)}) DO UPDATE SET {updates}
+    WHERE {differs}
+    """
+
+def upsert_weekly_data(tsv_stream, sqlite_file, variables, before_commit=None):
+    """
+    Update an existing database in place from tsv_stream, as in load_weekly_data. 
+    
+    Rows are matched on (region_id, period_end, duration), and only new or
+    changed rows are written to weekly_data_raw and map_snapshot. New dates
+    and regions are added to timeperiod_info and region_info, and renamed 
+    regions get their new name. Rows which are no longer in the file are 
+    left as they are.
+
+    This is all one transaction, so readers see either the old or new data.
+    The database is put in WAL mode, so app workers keep reading the old data
+    while it runs instead of waiting on the write lock. before_commit(con), 
+    eg. validate_database, is called once everything is written, and if it 
+    raises the whole upsert is rolled back.
+
+    Returns the number of rows read and the rows/sec throughput.
+    """
+    variables = list(variables)
+    columns = read_file_columns(tsv_stream, variables)
+    dtypes = get_column_dtypes(columns, variables)
+    table_columns = WEEKLY_KEY_COLUMNS + variables
+
+    con = sqlite3.connect(sqlite_file, isolation_level=None)
+    db_columns = pd.read_sql('PRAGMA table_info(weekly_data_raw)', con)['name'].tolist()
+    if set(table_columns) != set(db_columns):
+        raise RuntimeError('variables do not match weekly_data_raw, a full ingest is needed')
+    con.execute('PRAGMA journal_mode = WAL;')
+
+    # weekly_data_raw and map_snapshot have the same columns, with different keys
+    weekly_q = _upsert_query('weekly_data_raw', table_columns, WEEKLY_KEY_COLUMNS)
+    snapshot_q = _upsert_query('map_snapshot', table_columns, SNAPSHOT_KEY_COLUMNS)
+    timeperiod_q = """
+    INSERT INTO timeperiod_info (period_begin, period_end, duration) SELECT ?, ?, ?
+    WHERE NOT EXISTS (SELECT 1 FROM timeperiod_info WHERE period_begin = ? AND period_end = ? AND duration = ?)
+    """
+    # regions are keyed on type and id, the name can change
+    region_rename_q = """
+    UPDATE region_info SET region_name = ? 
+    WHERE region_type = ? AND region_id = ? AND region_name IS NOT ?
+    """
+    region_q = """
+    INSERT INTO region_info (region_type, region_id, region_name) SELECT ?, ?, ?
+    WHERE NOT EXISTS (SELECT 1 FROM region_info WHERE region_type = ? AND region_id = ?)
+    """
+
+    t0 = time.time()
+    n_rows = 0
+    timeperiods = set()
+    # {(region_type, region_id): region_name}, the last name in the file
+    regions = dict()
+
+    con.execute('BEGIN;')
+    try:
+        changes_before = con.total_changes
+        for file_chunk in tqdm(iter_file_chunks(tsv_stream, columns, dtypes), unit='chunk'):
+            rows = list(compact_chunk(file_chunk, variables).itertuples(index=False, name=None))
+            con.executemany(weekly_q, rows)
+            con.executemany(snapshot_q, rows)
+            timeperiods.update(file_chunk[['period_begin', 'period_end', 'duration']].itertuples(index=False, name=None))
+            regions.update(region_names(file_chunk))
+            n_rows += len(file_chunk)
+        # each changed row is written to both weekly_data_raw and map_snapshot
+        n_changed = (con.total_changes - changes_before) // 2
+
+        con.executemany(timeperiod_q, [t + t for t in timeperiods])
+        con.executemany(region_rename_q, [(n, t, i, n) for (t, i), n in regions.items()])
+        con.executemany(region_q, [(t, i, n, t, i) for (t, i), n in regions.items()])
+        
+        if before_commit is not None:
+            before_commit(con)
+    except BaseException:
+        con.execute('ROLLBACK;')
+        con.close()
+        raise
+    con.execute('COMMIT;')
+    con.close()
+
+    elapsed = time.time() - t0
+    rows_per_sec = n_rows / elapsed
+    logging.info(f'read {n_rows} rows in {elapsed:.1f} seconds, {rows_per_sec:.0f} rows/sec. {n_changed} rows inserted or updated')
+
+    return n_rows, rows_per_sec
+
+def validate_database(con):
+    """
+    Sanity checks of a new or updated database, raising AssertionError if 
+    any fail. con may be inside the transaction being checked.
+    """
+    var_info = get_variable_info()
+    region_info = pd.read_sql('select * from region_info', con)
+    
+    assert region_info['region_type'].drop_duplicates().sort_values().tolist() == ['county', 'metro'], "region_types not ['county','metro']"
+    assert len(region_info) > 3000, '<3000 entries in region info'
+    assert not region_info.duplicated(['region_type', 'region_id']).any(), 'duplicate region_ids in region_info'
+    
+    timeperiod_info = pd.read_sql('select distinct period_end, duration from timeperiod_info', con)
+    for duration, period_end_dates in timeperiod_info.groupby('duration').period_end:
+        # ensure proper date formats
+        period_end_dates = pd.to_datetime(period_end_dates, format='%Y-%m-%d')
+        most_recent_period = str(period_end_dates.max().date())
+        random_period = str(period_end_dates.sample(1).iloc[0].date())
+        
+        for variable in var_info.variable:
+            for period_end in [most_recent_period, random_period]:
+                q = f"""
+                SELECT region_id, period_end, duration, {variable}  
+                FROM map_snapshot 
+                WHERE period_end = {date_to_day(period_end)}
+                AND duration = {duration_code(duration)};
+                """
+                df = pd.read_sql(q, con)
+                assert len(df) > 0, f'query returned no data: {variable} {period_end} {duration}'
+
+def build_map_snapshot_table(sqlite_file, variables):
+    """
+    Create the map_snapshot table used by get_all_data_for_timeperiod_and_var.
+
+    This holds the same data as weekly_data_raw, but clustered on
+    (duration, period_end, region_id). All regions for a single map are
+    then stored next to each other, and a map refresh is one contiguous 
+    range read on the primary key.
+    """
+    variables = list(variables)
+    table_columns = ', '.join(WEEKLY_KEY_COLUMNS + variables)
+
+    with sqlite3.connect(sqlite_file) as con:
+        con.execute('drop table if exists map_snapshot;')
+        create_weekly_table(con, 'map_snapshot', SNAPSHOT_KEY_COLUMNS, variables)
+        q = f"""
+        insert into map_snapshot ({table_columns})
+        SELECT {table_columns}
         FROM weekly_data_raw
+        ORDER BY {', '.join(SNAPSHOT_KEY_COLUMNS)}
         """
         con.execute(q)
+
+def _region_timeseries_rows(duration, name, region_ids, values):
+    """ (duration, region_id, name, blob) rows of values, which are sorted on region_id then period_end """
+    if len(region_ids) == 0:
+        return
+    # start of each region's run of rows
+    starts = np.flatnonzero(np.r_[True, region_ids[1:] != region_ids[:-1]])
+    ends = np.r_[starts[1:], len(region_ids)]
     
-    logging.info('testing new database file')
+    for start, end in zip(starts, ends):
+        yield (duration, int(region_ids[start]), name, values[start:end].tobytes())
+
+# Regions per read of weekly_data_raw in build_region_timeseries_table
+REGION_BATCH_SIZE = 100
+
+def _region_id_ranges(con, batch_size):
+    """
+    (first, last) region_id ranges of about batch_size regions of region_info 
+    each. Together they cover every possible id, so also regions which are 
+    not in region_info.
+    """
+    region_ids = [r for (r,) in con.execute('select distinct region_id from region_info order by region_id;')]
+    bounds = region_ids[batch_size::batch_size]
+    firsts = [-2**63] + bounds
+    lasts = [b - 1 for b in bounds] + [2**63 - 1]
+    return list(zip(firsts, lasts))
+
+def build_region_timeseries_table(sqlite_file, variables):
+    """
+    Create the region_timeseries table used by utils.get_region_timeseries.
     
-    try:
-        var_info = get_variable_info()
-        
-        with sqlite3.connect(temp_sqlite_file) as con:
-            region_info = pd.read_sql('select * from region_info', con)
-            
-            assert region_info['region_type'].drop_duplicates().sort_values().tolist() == ['county', 'metro'], "region_types not ['county','metro']"
-            assert len(region_info) > 3000, '<3000 entries in region info'
-            
-            # ensure proper date formats
-            period_end_dates = pd.read_sql('select distinct period_end from timeperiod_info', con).period_end
-            period_end_dates = pd.to_datetime(period_end_dates)
-            most_recent_period = str(period_end_dates.max().date())
-            random_period = str(period_end_dates.sample(1).iloc[0].date())
+    For every (duration, region_id) each variable is stored as one blob, a 
+    float32 array sorted on period_end with NaN for missing values. The 
+    period_end days themselves are in the 'period_end' variable as int32. 
+    So the timeseries chart reads a handful of blobs, with no parsing or 
+    sorting. The table is replaced in a single transaction.
+    
+    It is written from one pass over each duration of weekly_data_raw, in
+    ranges of about REGION_BATCH_SIZE regions, so only the rows of those 
+    regions are in memory at once. Each range is a contiguous read of the 
+    table's key.
+    """
+    variables = list(variables)
+    columns = ', '.join(['period_end'] + variables)
+    
+    con = sqlite3.connect(sqlite_file, isolation_level=None)
+    con.execute('begin')
+    con.execute('drop table if exists region_timeseries;')
+    con.execute("""
+    create table region_timeseries (
+        duration INTEGER,
+        region_id INTEGER,
+        variable TEXT,
+        data BLOB,
+        PRIMARY KEY (duration, region_id, variable)
+    ) WITHOUT ROWID
+    """)
+    
+    durations = [d for (d,) in con.execute('select distinct duration from weekly_data_raw;')]
+    region_ranges = _region_id_ranges(con, REGION_BATCH_SIZE)
+    for duration in durations:
+        for first, last in region_ranges:
+            # a range of the weekly_data_raw key, already in this order
+            q = f"""
+            SELECT region_id, {columns}
+            FROM weekly_data_raw
+            WHERE duration = {duration} AND region_id BETWEEN {first} AND {last}
+            ORDER BY region_id, period_end
+            """
+            df = pd.read_sql(q, con)
+            region_ids = df['region_id'].to_numpy()
+            for name in ['period_end'] + variables:
+                if name == 'period_end':
+                    values = df[name].to_numpy(dtype='<i4')
+                else:
+                    values = df[name].to_numpy(dtype='<f4', na_value=np.nan)
+                con.executemany('insert into region_timeseries values (?, ?, ?, ?)',
+                                _region_timeseries_rows(duration, name, region_ids, values))
+    
+    con.execute('commit')
+    con.close()
+
+# Quantiles stored in snapshot_stats and global_stats
+STATS_QUANTILES = {'p05': 0.05, 'p50': 0.5, 'p95': 0.95}
+# Variables per read of map_snapshot in build_snapshot_stats_tables
+STATS_VARIABLE_BATCH_SIZE = 10
+
+def _quantile_rows(df, variables, by):
+    """ Rows of (*by, variable, p05, p50, p95) for every group of df """
+    stats = df.groupby(by)[variables].quantile(list(STATS_QUANTILES.values()))
+    # index (*by, quantile) and a column per variable, to (*by, variable) and a column per quantile
+    stats = stats.unstack(-1).stack(0)
+    return stats.reset_index().itertuples(index=False, name=None)
+
+def build_snapshot_stats_tables(sqlite_file, variables):
+    """
+    Create the tables of map colour ranges used by utils.get_map_value_range.
+
+    snapshot_stats has the quantiles of every map, ie. each (variable, duration,
+    period_end) in map_snapshot, for each geo type. global_stats has them over 
+    all dates for each (variable, duration, geo type), for a colour scale that 
+    stays the same as the date changes. Geo types are those of the app, 
+    'counties', 'metros' and 'all'. Both tables are replaced in one transaction.
+    
+    Quantiles over all dates need every value of a variable at once, so 
+    map_snapshot is read in groups of STATS_VARIABLE_BATCH_SIZE variables, 
+    one pass over each duration per group, which bounds the memory used.
+    """
+    variables = list(variables)
+    quantile_defs = ', '.join([f'{q} REAL' for q in STATS_QUANTILES])
+    
+    con = sqlite3.connect(sqlite_file, isolation_level=None)
+    con.execute('begin')
+    con.execute('drop table if exists snapshot_stats;')
+    con.execute('drop table if exists global_stats;')
+    con.execute(f"""
+    create table snapshot_stats (
+        duration INTEGER, period_end INTEGER, geo_type TEXT, variable TEXT, {quantile_defs},
+        PRIMARY KEY (variable, duration, period_end, geo_type)
+    ) WITHOUT ROWID
+    """)
+    con.execute(f"""
+    create table global_stats (
+        duration INTEGER, geo_type TEXT, variable TEXT, {quantile_defs},
+        PRIMARY KEY (variable, duration, geo_type)
+    ) WITHOUT ROWID
+    """)
+    
+    region_types = pd.read_sql('select region_id, region_type from region_info', con)
+    geo_types = region_types['region_type'].map({'county': 'counties', 'metro': 'metros'})
+    geo_types = pd.Series(geo_types.to_numpy(), index=region_types['region_id'].to_numpy())
+    
+    durations = [d for (d,) in con.execute('select distinct duration from map_snapshot;')]
+    for duration in durations:
+        for i in range(0, len(variables), STATS_VARIABLE_BATCH_SIZE):
+            batch = variables[i:i + STATS_VARIABLE_BATCH_SIZE]
+            q = f"""
+            SELECT duration, period_end, region_id, {', '.join(batch)}
+            FROM map_snapshot
+            WHERE duration = {duration}
+            """
+            df = pd.read_sql(q, con)
+            df[batch] = df[batch].astype('float32')
+            df['geo_type'] = df['region_id'].map(geo_types)
             
-            for variable in var_info.variable:
-                for duration in ['1 weeks','4 weeks','12 weeks']:
-                    for period_end in [most_recent_period, random_period]:
-                        pass
-                        q = f"""
-                        SELECT region_id, period_end, duration, {variable}  
-                        FROM weekly_data_raw 
-                        WHERE period_end = '{period_end}'
-                        AND duration = '{duration}';
-                        """
-                        df = pd.read_sql(q, con)
-                        assert len(df) == 0, f'query returned no data: {variable} {period_end} {duration}'
-    except Exception as e:
-        logging.error(f'Failed new database tests with error {e}')
+            for geo_type, geo_df in [('all', df.assign(geo_type='all')), *df.groupby('geo_type')]:
+                con.executemany('insert into snapshot_stats values (?, ?, ?, ?, ?, ?, ?)',
+                                _quantile_rows(geo_df, batch, ['duration', 'period_end', 'geo_type']))
+                con.executemany('insert into global_stats values (?, ?, ?, ?, ?, ?)',
+                                _quantile_rows(geo_df, batch, ['duration', 'geo_type']))
+    
+    con.execute('commit')
+    con.close()
+
+def write_data_version(sqlite_file, md5sum):
+    """
+    Record the md5 of the source redfin file in the data_info table. The app 
+    uses it as the data version, see utils.get_data_version.
+    """
+    with sqlite3.connect(sqlite_file) as con:
+        con.execute('create table if not exists data_info (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID;')
+        con.executemany('insert or replace into data_info values (?, ?)', [
+            ('md5sum', md5sum),
+            ('ingested', str(pd.Timestamp.now())),
+            ])
+
+if __name__ == "__main__":
+
+    logging.info('------------BEGIN redfin data ingest---------------')
+    
+    file_log = pd.read_csv(cfg['redfin_file_log'])
+    current_file_info = file_log.query('current_source').iloc[0]
+    
+    # the file exactly as downloaded, possibly gzipped
+    new_raw_data_file = cfg['redfin_data_dir'].joinpath('temp.download')
+    
+    # etag and last_modified were not logged by older versions
+    previous_etag = current_file_info.get('etag')
+    previous_last_modified = current_file_info.get('last_modified')
+    
+    variables = get_variable_info().variable
+    if cfg['ingest_mode'] == 'incremental':
+        new_db_file = cfg['data_db']
+    else:
+        new_db_file = cfg['data_db'].parent.joinpath('temp.sqlite')
+    
+    # Download, hash and parse in one pass over the file
+    logging.info('downloading and parsing latest file')
+    with RedfinDownload(cfg['redfin_data_url'], 
+                        archive_file = new_raw_data_file,
+                        etag = previous_etag if pd.notnull(previous_etag) else None,
+                        last_modified = previous_last_modified if pd.notnull(previous_last_modified) else None,
+                        ) as download:
+        if download.not_modified:
+            logging.info('server reports the file is unchanged. quitting')
+            exit()
+        
+        # Servers without conditional requests send the file again even when
+        # it is unchanged, so its md5 is checked once it has been read, 
+        # before anything is committed or built from it
+        def check_file_changed():
+            if download.finish() == current_file_info.md5sum:
+                raise FileUnchanged()
+        
+        def check_before_commit(con):
+            check_file_changed()
+            validate_database(con)
+        
+        try:
+            if cfg['ingest_mode'] == 'incremental':
+                logging.info('upserting new and changed rows into the current database, testing them before the commit')
+                n_rows, ingest_rows_per_sec = upsert_weekly_data(download.stream, new_db_file, variables, 
+                                                                 before_commit=check_before_commit)
+            else:
+                n_rows, ingest_rows_per_sec = build_database(download.stream, new_db_file, variables, 
+                                                             after_load=check_file_changed)
+        except FileUnchanged:
+            logging.info('latest file matches md5 of older file. quitting')
+            new_raw_data_file.unlink()
+            if cfg['ingest_mode'] != 'incremental':
+                new_db_file.unlink()
+            exit()
+        except AssertionError as e:
+            # only raised here in incremental mode, by validate_database
+            logging.error(f'Failed database tests with error {e}. upsert rolled back')
+            new_raw_data_file.unlink()
+            exit(1)
+    
+    logging.info('new file has new md5. continuing ingest')
+    newfile_md5 = download.md5
+    
+    if cfg['ingest_mode'] == 'incremental':
+        # blobs cover whole regions, and stats whole maps, so these are rebuilt rather than upserted
+        logging.info('rebuilding region_timeseries, snapshot_stats and global_stats tables')
+        build_region_timeseries_table(new_db_file, variables)
+        build_snapshot_stats_tables(new_db_file, variables)
+    else:
+        # in incremental mode this was done before the upsert was committed
+        logging.info('testing new database file')
+        try:
+            with sqlite3.connect(new_db_file) as con:
+                validate_database(con)
+        except AssertionError as e:
+            logging.error(f'Failed new database tests with error {e}. keeping the current database')
+            new_raw_data_file.unlink()
+            new_db_file.unlink()
+            exit(1)
     
     logging.info('testing passed. implementing new database file')
+    
+    # after this, and the swap below in full mode, app workers reload their lookups
+    write_data_version(new_db_file, newfile_md5)
+    
+    if cfg['data_engine'] == 'parquet':
+        logging.info('writing parquet datasets')
+        write_parquet_datasets(new_db_file, variables)
+    elif cfg['data_engine'] == 'npy':
+        logging.info('writing npy cube')
+        write_npy_cube(new_db_file, cfg['data_dirs']['weekly_data_cube'], variables)
     # TODO: clear old tsv files and sqlite files
     
     primary_filename = cfg['data_db']
     today = str(pd.Timestamp.now().date())
     
-    # shuffle old and new database files
-    archive_filename = primary_filename.stem + f'_archive_{today}.sqlite'
-    archive_filepath = primary_filename.parent.joinpath(archive_filename)
+    if cfg['ingest_mode'] != 'incremental':
+        # shuffle old and new database files
+        archive_filename = primary_filename.stem + f'_archive_{today}.sqlite'
+        archive_filepath = primary_filename.parent.joinpath(archive_filename)
+        
+        # current sqlite is kept as an archive, as a hard link to the same 
+        # file where possible, so the primary name never goes missing
+        if primary_filename.exists():
+            try:
+                os.link(primary_filename, archive_filepath)
+            except OSError:
+                shutil.copy2(primary_filename, archive_filepath)
+        # newest sqlite created above becomes the current, in one atomic step
+        os.replace(new_db_file, primary_filename)
     
-    # current sqlite becomes an archive 
-    primary_filename.rename(archive_filepath)
-    # newest sqlite created above becomes the current
-    temp_sqlite_file.rename(primary_filename)
+    # lookups for app startup, from the database now in place
+    write_app_lookups_file()
     
     # archive the new downloaded tsv file
-    new_raw_data_file_perm_name = new_raw_data_file.parent.joinpath(f'redfin_weekly_data_{today}.tsv')
+    suffix = '.tsv.gz' if download.compressed else '.tsv'
+    new_raw_data_file_perm_name = new_raw_data_file.parent.joinpath(f'redfin_weekly_data_{today}{suffix}')
     new_raw_data_file.rename(new_raw_data_file_perm_name)
     
     # add new info to the log
@@ -195,7 +917,10 @@ if __name__ == "__main__":
         'date_downloaded' : today,
         'md5sum' : newfile_md5,
         'filesize_bytes' : new_raw_data_file_perm_name.stat().st_size,
-        'linecount' : n_lines,
+        'linecount' : n_rows + 1, # including the header
+        'ingest_rows_per_sec' : round(ingest_rows_per_sec),
+        'etag' : download.etag,
+        'last_modified' : download.last_modified,
         }]
     
     file_log['current_source'] = False
@@ -203,43 +928,3 @@ if __name__ == "__main__":
     file_log.to_csv(cfg['redfin_file_log'], index=False)
     
     logging.info('------------END redfin data ingest---------------')
-    # #------------------------------------------------
-    # with sqlite3.connect(sqlite_file) as con:
-    #     region_info = pd.read_sql_query('select distinct region_id, region_type_id, region_name, region_type from weekly_data_raw;', con)
-    #     date_info   = pd.read_sql_query('select distinct period_begin, period_end, duration from weekly_data_raw;', con)
-    
-    
-    # # Parquet files optimbes by region_id
-    # for region_id in tqdm(region_info.region_id):
-    #     with sqlite3.connect(sqlite_file) as con:
-    #         df = pd.read_sql_query(f"select * from weekly_data_raw where region_id={region_id}", con)
-    #         df.to_parquet(parquet_dir_by_region, partition_cols='region_id')
-    
-    # # not sure if I need the below partitioned  by date yet,
-    # # for the map I may just need the most recent
-    # #
-    
-    
-    # all_dates_and_durations = expand_grid({'period_end': date_info.period_end.unique(),
-    #                                       'duration'  : date_info.duration.unique()})
-    
-    # # speed things up for testing by only doing recent dates
-    # #all_dates_and_durations = all_dates_and_durations[all_dates_and_durations.period_end.str.contains('2023|2024')]
-    
-    # # parquet files optimized by date (period_end) and duration
-    # for date_info in tqdm(all_dates_and_durations.itertuples(), total=len(all_dates_and_durations)):
-    #     pass
-    #     with sqlite3.connect(sqlite_file) as con:
-    #         q = """
-    #         SELECT * from weekly_data_raw 
-    #         WHERE period_end='{date_info.period_end}' 
-    #         AND duration='{date_info.duration}'
-    #         """
-    #         df = pd.read_sql_query(q, con)
-    #         df.to_parquet(parquet_dir_by_date, partition_cols=['period_end', 'duration'])
-    
-
-
-
-
-
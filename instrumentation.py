@@ -0,0 +1,143 @@
+"""
+Latency histograms for the Dash callbacks, served in Prometheus text format.
+
+Callbacks are wrapped with instrument_callback, and stages within them timed
+with span, eg.
+
+    @app.callback(...)
+    @instrument_callback
+    def update_Choropleth(...):
+        with span('query'):
+            ...
+
+init_instrumentation adds the /metrics endpoint, and also records the time
+between a callback returning and its response being sent, mostly json
+serialization and compression, as the 'serialize' stage. When disabled
+everything here is a no-op.
+
+The histograms are per process. Under gunicorn with several workers each
+/metrics request is answered by one of them, with only its own calls, so
+scrape each worker or treat a scrape as a sample.
+"""
+import bisect
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import Response, g, has_request_context
+
+# seconds, upper bounds of the histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+enabled = True
+_current = threading.local()
+
+
+class Histogram:
+    """ Prometheus style histogram with one series per tuple of label values """
+    def __init__(self, name, help_text, label_names, buckets=BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = dict()
+        self._lock = threading.Lock()
+
+    def observe(self, labels, seconds):
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # a count per bucket plus +Inf, then the sum
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[i] += 1
+            series[-1] += seconds
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = {labels: list(values) for labels, values in self._series.items()}
+        for labels, values in sorted(series.items()):
+            label_str = ','.join(f'{k}="{v}"' for k, v in zip(self.label_names, labels))
+            cumulative = 0
+            for le, count in zip([*map(str, self.buckets), '+Inf'], values[:-1]):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label_str},le="{le}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{label_str}}} {values[-1]}')
+            lines.append(f'{self.name}_count{{{label_str}}} {cumulative}')
+        return lines
+
+
+callback_seconds = Histogram('dash_callback_seconds', 'Time in each Dash callback', ('callback',))
+stage_seconds = Histogram('dash_callback_stage_seconds', 'Time in each stage of a Dash callback', ('callback', 'stage'))
+
+# functions returning {metric name: (type, help, value)}, added to /metrics
+_collectors = []
+
+
+def register_collector(collector):
+    _collectors.append(collector)
+
+
+def instrument_callback(f):
+    """ Record the time of each call of f, and make it the callback of its spans """
+    if not enabled:
+        return f
+
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        _current.callback = f.__name__
+        t0 = time.perf_counter()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - t0
+            callback_seconds.observe((f.__name__,), elapsed)
+            # for the serialize stage in init_instrumentation
+            if has_request_context():
+                g.instrumented_callback = (f.__name__, time.perf_counter())
+            _current.callback = None
+    return wrapper
+
+
+@contextmanager
+def span(stage):
+    """ Record the time of the with block as stage of the current callback """
+    callback = getattr(_current, 'callback', None)
+    if not enabled or callback is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe((callback, stage), time.perf_counter() - t0)
+
+
+def render_metrics():
+    lines = callback_seconds.render() + stage_seconds.render()
+    for collector in _collectors:
+        for name, (metric_type, help_text, value) in collector().items():
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {metric_type}', f'{name} {value}']
+    return '\n'.join(lines) + '\n'
+
+
+def init_instrumentation(server, enable=True):
+    """ Turn instrumentation on or off, and if on add /metrics to server """
+    global enabled
+    enabled = enable
+    if not enabled:
+        return
+
+    @server.after_request
+    def record_serialize_stage(response):
+        # Registered before other after_request hooks, so runs after them, eg. compression
+        if 'instrumented_callback' in g:
+            callback, returned = g.instrumented_callback
+            stage_seconds.observe((callback, 'serialize'), time.perf_counter() - returned)
+        return response
+
+    @server.route('/metrics')
+    def metrics():
+        return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
@@ -7,7 +7,9 @@ from random import random
 
 from shapely.ops import transform
 
-from utils import get_all_region_info
+from config import config as cfg
+from utils import get_all_region_info, get_geodata_tier_file
+from vector_tiles import write_mbtiles
 
 redfin_county_info = get_all_region_info(return_mapping=False).query("region_type=='county'")
 
@@ -29,8 +31,8 @@ def round_coordinates(geom, ndigits=2):
 shapes = gpd.read_file('~/data/natural_earth_counties/ne_10m_admin_2_counties_lakes.shp')
 
 DEST_FILE = './assets/geodata_counties.json'
-SIMPLIFCATION_FACTOR = 0.01
-PRECISION = 2
+# The untiered DEST_FILE uses the same simplification as this tier
+DEST_FILE_TIER = 'medium'
 COLUMN_LUT = {   # old->new, also signifies which to keep
     'NAME' : 'county',
     'REGION' : 'state',
@@ -43,10 +45,6 @@ COLUMN_LUT = {   # old->new, also signifies which to keep
 
 shapes = shapes[COLUMN_LUT.keys()].rename(columns=COLUMN_LUT)
 
-shapes['geometry'] = shapes.simplify(SIMPLIFCATION_FACTOR)
-
-shapes['geometry'] = shapes.geometry.apply(round_coordinates, ndigits=PRECISION)
-
 shapes['name'] = shapes.apply(lambda r: f'{r.county_and_type}, {r.state}', axis=1)
 
 #-----------------------------------------------------
@@ -88,16 +86,32 @@ redfin_counties_without_shapes = redfin_county_info.query("~region_name.isin(@sh
 # Virginia has a bunch of cities listed as counties since they are "independent" cities
 redfin_counties_without_shapes = redfin_counties_without_shapes.query("~region_name.str.contains('AK')").query("~region_name.str.contains('VA')")
 
-shape_json = shapes.__geo_interface__
-
-with open(DEST_FILE,'w') as f:
-    json.dump(shape_json, f, separators=(',', ':'))
-
-
-
-
-
+#-----------------------------------------------------
+# write one file per zoom tier, each simplified then quantized by rounding
+# coordinates. Simplification is done per tier from the full resolution shapes.
 
+def write_simplified(shapes, dest_file, tolerance, precision):
+    tier_shapes = shapes.copy()
+    tier_shapes['geometry'] = tier_shapes.simplify(tolerance)
+    tier_shapes['geometry'] = tier_shapes.geometry.apply(round_coordinates, ndigits=precision)
+    
+    with open(dest_file,'w') as f:
+        json.dump(tier_shapes.__geo_interface__, f, separators=(',', ':'))
 
+for tier, tier_info in cfg['geodata_tiers'].items():
+    tier_file = cfg['assets dir'].joinpath(get_geodata_tier_file('counties', tier))
+    write_simplified(shapes, tier_file, tier_info['tolerance'], tier_info['precision'])
 
+dest_tier_info = cfg['geodata_tiers'][DEST_FILE_TIER]
+write_simplified(shapes, DEST_FILE, dest_tier_info['tolerance'], dest_tier_info['precision'])
 
+#-----------------------------------------------------
+# vector tiles, from the full resolution shapes since each zoom is simplified separately
+write_mbtiles(
+    shapes, 
+    cfg['vector_tile_files']['counties'], 
+    layer_name = 'counties',
+    min_zoom   = cfg['vector_tile_zooms'][0],
+    max_zoom   = cfg['vector_tile_zooms'][1],
+    properties = ['name'],
+    )
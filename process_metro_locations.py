@@ -10,6 +10,7 @@ from utils import get_all_region_info
 from tqdm import tqdm
 
 from config import config as cfg
+from vector_tiles import write_mbtiles
 
 redfin_metro_info = get_all_region_info(return_mapping=False).query("region_type=='metro'")
 
@@ -134,7 +135,12 @@ dst_file = cfg['assets dir'].joinpath(cfg['geodata_files']['metros'])
 
 with open(dst_file,'w') as f:
     json.dump(city_json, f, separators=(',', ':'))
-    
-
-
 
+write_mbtiles(
+    star_shapes, 
+    cfg['vector_tile_files']['metros'], 
+    layer_name = 'metros',
+    min_zoom   = cfg['vector_tile_zooms'][0],
+    max_zoom   = cfg['vector_tile_zooms'][1],
+    properties = ['region_name', 'region_id'],
+    )
@@ -0,0 +1,108 @@
+"""
+Encoding of the responses sent by the app, set up with init_response_encoding.
+
+Figures are serialized with orjson when it is installed, and responses over
+a size threshold are compressed with brotli or gzip, whichever the browser
+accepts. Numeric arrays can be sent as typed arrays, see typed_array, which
+plotly.js decodes straight into a Float32Array etc. instead of parsing a
+list of numbers.
+"""
+import base64
+import gzip
+import logging
+
+import numpy as np
+import plotly.io as pio
+from flask import request
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# numpy dtypes to plotly.js typed array names
+TYPED_ARRAY_DTYPES = {
+    np.dtype('float32'): 'f4',
+    np.dtype('float64'): 'f8',
+    np.dtype('int32')  : 'i4',
+    np.dtype('uint32') : 'u4',
+    np.dtype('int16')  : 'i2',
+    np.dtype('uint16') : 'u2',
+    np.dtype('int8')   : 'i1',
+    np.dtype('uint8')  : 'u1',
+}
+
+
+def typed_array(values, dtype='float32'):
+    """
+    values as a plotly.js typed array, {'dtype': 'f4', 'bdata': <base64>}.
+    For arrays set directly in a figure dict or Patch. Decoding them needs 
+    plotly.js 2.28, as in dash 2.15, see requirements.txt. Arrays given to 
+    plotly 5 graph objects are still sent as lists.
+    """
+    dtype = np.dtype(dtype)
+    # plotly.js reads the bytes as little endian
+    values = np.ascontiguousarray(values, dtype=dtype.newbyteorder('<'))
+    return {
+        'dtype': TYPED_ARRAY_DTYPES[dtype],
+        'bdata': base64.b64encode(values.tobytes()).decode('ascii'),
+    }
+
+
+def compress(data, encoding, level=None):
+    """ data compressed with encoding, 'br' or 'gzip' """
+    if encoding == 'br':
+        return brotli.compress(data, quality=4 if level is None else level)
+    return gzip.compress(data, compresslevel=6 if level is None else level)
+
+
+def choose_encoding(accept_encodings):
+    """ 'br' or 'gzip' from the request Accept-Encoding, or None """
+    if brotli is not None and 'br' in accept_encodings:
+        return 'br'
+    if 'gzip' in accept_encodings:
+        return 'gzip'
+    return None
+
+
+def init_response_encoding(server, min_bytes=1024, mimetypes=('application/json', 'text/html')):
+    """
+    Use orjson for figures, and compress responses of mimetypes of at least
+    min_bytes. Static files are left alone, as are responses which already
+    have a Content-Encoding, eg. the vector tiles.
+    """
+    if orjson is None:
+        logging.warning('orjson is not installed, using the standard json encoder for figures')
+    elif not hasattr(pio, 'json'):
+        # the json engine setting is only in newer plotly versions
+        logging.warning('plotly has no json engine setting, using the standard json encoder for figures')
+    else:
+        pio.json.config.default_engine = 'orjson'
+
+    @server.after_request
+    def compress_response(response):
+        if (response.direct_passthrough
+                or response.status_code != 200
+                or 'Content-Encoding' in response.headers
+                or response.mimetype not in mimetypes):
+            return response
+
+        encoding = choose_encoding(request.accept_encodings)
+        if encoding is None:
+            return response
+
+        data = response.get_data()
+        if len(data) < min_bytes:
+            return response
+
+        response.set_data(compress(data, encoding))
+        response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        return response
+
+    return compress_response
@@ -0,0 +1,143 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from utils import get_all_data_for_timeperiod_and_var
+
+
+class SnapshotCache:
+    """
+    In process LRU cache of map data, keyed on (variable, duration, period_end, data_version).
+
+    Entries are compact numpy arrays (region_id int32, value float32) rather
+    than DataFrames or figures, and the cache is bounded by the total bytes of
+    those arrays. Least recently used entries are evicted first.
+
+    prefetch loads entries in a pool of prefetch_workers background threads,
+    eg. the next dates while a user steps through them.
+    """
+    def __init__(self, max_bytes, prefetch_workers=4):
+        self.max_bytes = max_bytes
+        self.prefetch_workers = prefetch_workers
+        self._entries = OrderedDict()
+        self._loading = dict()
+        self._lock = threading.Lock()
+        # incremented by clear, so loads started before it are not cached after it
+        self._generation = 0
+        # created on first use, so it belongs to the process using it and
+        # not a gunicorn master that forked it
+        self._executor = None
+        self._executor_pid = None
+
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def load(variable, duration, period_end, data_version):
+        df = get_all_data_for_timeperiod_and_var(variable, duration=duration, period_end=period_end)
+        region_ids = df['region_id'].to_numpy(dtype=np.int32)
+        values = df[variable].to_numpy(dtype=np.float32)
+        return region_ids, values
+
+    def get(self, variable, duration, period_end, data_version):
+        """ 
+        Return (region_ids, values) arrays for a single map. data_version is 
+        part of the key so entries loaded from an older database are never returned.
+        """
+        key = (variable, duration, period_end, data_version)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            loading = self._loading.get(key)
+            generation = self._generation
+
+        if loading is not None:
+            # already being prefetched
+            return loading.result()
+
+        # Load outside the lock so one slow query does not block other threads.
+        entry = self.load(*key)
+        self._put(key, entry, generation)
+        return entry
+
+    def _put(self, key, entry, generation):
+        entry_bytes = sum(a.nbytes for a in entry)
+        with self._lock:
+            if key in self._entries or generation != self._generation:
+                return
+            self._entries[key] = entry
+            self.nbytes += entry_bytes
+
+            while self.nbytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= sum(a.nbytes for a in evicted)
+                self.evictions += 1
+
+    def _load_and_put(self, key, generation):
+        try:
+            entry = self.load(*key)
+            self._put(key, entry, generation)
+            return entry
+        finally:
+            with self._lock:
+                if generation == self._generation:
+                    self._loading.pop(key, None)
+
+    def prefetch(self, keys):
+        """
+        Start loading keys that are not cached or already loading, in background 
+        threads. Returns the futures of the loads started. get waits for these
+        rather than loading the same key again.
+        """
+        futures = []
+        with self._lock:
+            if self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.prefetch_workers, thread_name_prefix='snapshot_prefetch')
+                self._executor_pid = os.getpid()
+            for key in keys:
+                if key in self._entries or key in self._loading:
+                    continue
+                future = self._executor.submit(self._load_and_put, key, self._generation)
+                self._loading[key] = future
+                futures.append(future)
+        return futures
+
+    def prewarm(self, keys):
+        """ Load all (variable, duration, period_end, data_version) keys not already cached """
+        for key in keys:
+            with self._lock:
+                cached = key in self._entries
+                generation = self._generation
+            if not cached:
+                self._put(key, self.load(*key), generation)
+        stats = self.stats()
+        logging.info(f'snapshot cache prewarmed with {stats["entries"]} entries, {stats["bytes"]/1024**2:.1f} MB')
+
+    def clear(self):
+        """ Drop all entries. Loads still running finish, but are not cached. """
+        with self._lock:
+            self._entries.clear()
+            self._loading.clear()
+            self._generation += 1
+            self.nbytes = 0
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                entries   = len(self._entries),
+                bytes     = self.nbytes,
+                max_bytes = self.max_bytes,
+                hits      = self.hits,
+                misses    = self.misses,
+                evictions = self.evictions,
+                loading   = len(self._loading),
+            )
@@ -0,0 +1,164 @@
+import os
+
+import pytest
+from flask import Flask
+from flask_caching import Cache
+
+import cache_backends
+from cache_backends import CompressedRedisCache, SQLiteCache, dump_payload, get_cache_config
+from config import config as cfg
+
+
+class Clock:
+    """ Stand in for the time module in cache_backends """
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache_backends, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def cache(tmp_path, clock):
+    return SQLiteCache(tmp_path.joinpath('cache.sqlite'), max_bytes=10_000, default_timeout=60)
+
+
+def total_bytes(cache):
+    return cache._connection().execute('SELECT coalesce(sum(nbytes), 0) FROM cache;').fetchone()[0]
+
+
+def test_set_get(cache):
+    assert cache.get('a') is None
+    assert cache.set('a', {'x': [1, 2, 3]})
+    assert cache.get('a') == {'x': [1, 2, 3]}
+    assert cache.has('a')
+
+
+def test_large_values_are_compressed(cache):
+    value = 'abc' * 1000
+    assert dump_payload(value)[:1] == b'z'
+    cache.set('a', value)
+    assert cache.get('a') == value
+
+
+def test_add_only_sets_missing_keys(cache):
+    assert cache.add('a', 1)
+    assert not cache.add('a', 2)
+    assert cache.get('a') == 1
+
+
+def test_expiry(cache, clock):
+    cache.set('a', 1)
+    cache.set('b', 2, timeout=0)
+    clock.now += 61
+    assert cache.get('a') is None
+    assert not cache.has('a')
+    # 0 never expires
+    assert cache.get('b') == 2
+    # an expired key can be added again
+    assert cache.add('a', 3)
+    assert cache.get('a') == 3
+
+
+def test_delete_and_clear(cache):
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.delete('a')
+    assert not cache.delete('a')
+    assert cache.stats()['bytes'] == total_bytes(cache)
+    cache.clear()
+    assert cache.get('b') is None
+    assert cache.stats() == dict(entries=0, bytes=0, max_bytes=10_000)
+
+
+def test_running_size(cache):
+    cache.set('a', b'1' * 100)
+    cache.set('b', b'2' * 200)
+    # replacing a key counts only its new size
+    cache.set('a', b'3' * 300)
+    assert cache.stats()['bytes'] == total_bytes(cache)
+    assert cache.stats()['entries'] == 2
+
+
+def test_eviction_is_least_recently_used(cache, clock):
+    # incompressible, so each entry is about 3000 bytes
+    values = {k: os.urandom(3000) for k in 'abc'}
+    for k, v in values.items():
+        clock.now += 1
+        cache.set(k, v)
+    clock.now += 1
+    # a read makes 'a' the most recently used, once flushed by the next set
+    assert cache.get('a') == values['a']
+
+    clock.now += 1
+    cache.set('d', values['a'])
+
+    assert cache.get('b') is None
+    assert [cache.has(k) for k in 'acd'] == [True, True, True]
+    assert cache.stats()['bytes'] == total_bytes(cache) <= 10_000
+
+
+def test_expired_entries_are_evicted_first(cache, clock):
+    value = os.urandom(3000)
+    cache.set('a', value)
+    cache.set('b', value, timeout=10)
+    cache.set('c', value)
+    clock.now += 11
+    cache.set('d', value)
+
+    assert not cache.has('b')
+    assert [cache.has(k) for k in 'acd'] == [True, True, True]
+    assert cache.stats()['bytes'] == total_bytes(cache)
+
+
+def test_shared_between_instances(tmp_path, clock):
+    # eg. two gunicorn workers
+    path = tmp_path.joinpath('cache.sqlite')
+    first = SQLiteCache(path, max_bytes=10_000)
+    second = SQLiteCache(path, max_bytes=10_000)
+    first.set('a', 1)
+    assert second.get('a') == 1
+    assert second.stats()['bytes'] == first.stats()['bytes']
+
+
+def test_connection_after_fork(cache, monkeypatch):
+    con = cache._connection()
+    monkeypatch.setattr(os, 'getpid', lambda: -1)
+    # a new connection in the child, with the parent's kept open
+    assert cache._connection() is not con
+    assert con in cache_backends._inherited_connections
+    con.execute('SELECT 1;')
+    cache.set('a', 1)
+    assert cache.get('a') == 1
+
+
+@pytest.mark.parametrize('backend', ['sqlite', 'redis', 'filesystem'])
+def test_flask_caching_config(backend, tmp_path):
+    app_cfg = dict(cfg, cache_backend=backend)
+    app_cfg['cache dir'] = str(tmp_path)
+    app_cfg['cache_sqlite_file'] = tmp_path.joinpath('cache.sqlite')
+    config = get_cache_config(app_cfg)
+    if backend == 'redis':
+        # a client object is used as is, so nothing connects here
+        config['CACHE_REDIS_CLIENT'] = object()
+
+    server = Flask(__name__)
+    cache = Cache(server, config=config)
+    backend_cache = server.extensions['cache'][cache]
+    if backend == 'sqlite':
+        assert isinstance(backend_cache, SQLiteCache)
+        assert backend_cache.default_timeout == cfg['timeout']
+    elif backend == 'redis':
+        assert isinstance(backend_cache, CompressedRedisCache)
+        return
+
+    with server.app_context():
+        cache.set('a', {'x': 1})
+        assert cache.get('a') == {'x': 1}
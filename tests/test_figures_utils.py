@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+
+from figures_utils import downsample_timeseries, get_choropleth_args, lttb_indices
+
+
+def random_walk(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.arange(n, dtype=float), rng.normal(size=n).cumsum()
+
+
+def test_lttb_keeps_endpoints():
+    x, y = random_walk(1000)
+    keep = lttb_indices(x, y, 50)
+    assert keep[0] == 0
+    assert keep[-1] == len(x) - 1
+
+
+def test_lttb_number_of_points():
+    x, y = random_walk(1000)
+    for n_out in [3, 10, 50, 999]:
+        keep = lttb_indices(x, y, n_out)
+        assert len(keep) == n_out
+        # one point per bucket, so in order and never repeated
+        assert (np.diff(keep) > 0).all()
+
+
+def test_lttb_passthrough():
+    x, y = random_walk(100)
+    for n_out in [100, 101, 1000]:
+        assert (lttb_indices(x, y, n_out) == np.arange(100)).all()
+    # too few points for any buckets
+    assert (lttb_indices(x, y, 2) == np.arange(100)).all()
+
+
+def test_lttb_keeps_spikes():
+    x = np.arange(1000, dtype=float)
+    y = np.zeros(1000)
+    y[[123, 456, 789]] = [10, -10, 10]
+    keep = lttb_indices(x, y, 20)
+    assert {123, 456, 789} <= set(keep)
+
+
+def test_downsample_timeseries_per_group():
+    period_end = pd.date_range('2015-01-04', periods=500, freq='W')
+    df = pd.DataFrame({
+        'region_id'  : np.repeat([1, 2], [500, 50]),
+        'period_end' : np.r_[period_end, period_end[:50]],
+        'Price'      : np.r_[random_walk(500)[1], random_walk(50)[1]],
+        })
+    out = downsample_timeseries(df, 'period_end', 'Price', 'region_id', 100)
+    counts = out.groupby('region_id').size()
+    assert counts[1] == 100
+    # already fewer points, so unchanged
+    assert counts[2] == 50
+    assert out.groupby('region_id')['period_end'].is_monotonic_increasing.all()
+
+
+def test_downsample_timeseries_x_range():
+    period_end = pd.date_range('2015-01-04', periods=500, freq='W')
+    df = pd.DataFrame({'region_id': 1, 'period_end': period_end, 'Price': random_walk(500)[1]})
+    x_range = ('2018-01-01', '2018-06-30')
+    out = downsample_timeseries(df, 'period_end', 'Price', 'region_id', 100, x_range)
+    inside = df[(df.period_end >= x_range[0]) & (df.period_end <= x_range[1])]
+    # every point in range, and one either side
+    assert len(out) == len(inside) + 2
+
+
+def test_choropleth_args_value_range():
+    df = pd.DataFrame({'region_id': range(101), 'region_name': 'x', 'Price': np.arange(101.0)})
+    arg = get_choropleth_args(df, 'Price')
+    assert (arg['min_value'], arg['max_value']) == (5, 95)
+    arg = get_choropleth_args(df, 'Price', value_range=(1, 2))
+    assert (arg['min_value'], arg['max_value']) == (1, 2)
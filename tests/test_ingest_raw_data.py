@@ -0,0 +1,249 @@
+import gzip
+import hashlib
+import io
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import ingest_raw_data
+from ingest_raw_data import HashingReader, RedfinDownload, iter_byte_chunks, iter_file_chunks
+from ingest_raw_data import get_column_dtypes, read_file_columns, load_weekly_data
+from ingest_raw_data import build_map_snapshot_table, upsert_weekly_data
+from ingest_raw_data import build_region_timeseries_table, build_snapshot_stats_tables
+
+VARIABLES = ['active_listings', 'median_active_list_price']
+
+def redfin_tsv(n_regions=3, n_weeks=4):
+    """ A small redfin file, as bytes """
+    rows = ['\t'.join(['region_id', 'region_type', 'region_name', 'duration',
+                       'period_begin', 'period_end'] + VARIABLES)]
+    for region_id in range(1, n_regions + 1):
+        for week in range(n_weeks):
+            period_end = pd.Timestamp('2022-01-02') + pd.Timedelta(weeks=week)
+            period_begin = period_end - pd.Timedelta(weeks=4)
+            rows.append('\t'.join([str(region_id), 'county', f'County {region_id}', '4 weeks',
+                                   str(period_begin.date()), str(period_end.date()),
+                                   str(region_id * 10 + week), '' if week == 1 else str(1.5 * week)]))
+    return ('\n'.join(rows) + '\n').encode()
+
+class FakeResponse:
+    """ Stands in for a streamed requests response """
+    def __init__(self, body, status_code=200, headers=None):
+        self.raw = io.BytesIO(body)
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.closed = False
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(self.status_code)
+
+    def close(self):
+        self.closed = True
+
+@pytest.fixture
+def serve(monkeypatch):
+    """ Answer requests.get with a FakeResponse of body, recording the request headers """
+    requests_made = []
+    def serve(body, **kwargs):
+        def get(url, headers=None, **_):
+            requests_made.append(headers)
+            return FakeResponse(body, **kwargs)
+        monkeypatch.setattr(ingest_raw_data.requests, 'get', get)
+        return requests_made
+    return serve
+
+@pytest.fixture(autouse=True)
+def one_worker(monkeypatch):
+    monkeypatch.setitem(ingest_raw_data.cfg, 'ingest_workers', 1)
+    monkeypatch.setitem(ingest_raw_data.cfg, 'ingest_chunk_MB', 1)
+
+def test_hashing_reader_gzip():
+    data = redfin_tsv(50, 50)
+    compressed = gzip.compress(data)
+    tee = io.BytesIO()
+    source = HashingReader(io.BytesIO(compressed), tee_file=tee)
+    stream = gzip.GzipFile(fileobj=io.BufferedReader(source))
+
+    assert stream.read() == data
+    source.drain()
+    assert source.md5.hexdigest() == hashlib.md5(compressed).hexdigest()
+    assert source.n_bytes == len(compressed)
+    assert tee.getvalue() == compressed
+
+def test_hashing_reader_drain():
+    data = b'x' * (3 * ingest_raw_data.MB + 5)
+    tee = io.BytesIO()
+    source = HashingReader(io.BytesIO(data), tee_file=tee)
+    source.read(10)
+    source.drain()
+    # nothing left, so a second drain changes nothing
+    source.drain()
+    assert source.md5.hexdigest() == hashlib.md5(data).hexdigest()
+    assert source.n_bytes == len(data)
+    assert tee.getvalue() == data
+
+@pytest.mark.parametrize('chunk_bytes', [1, 7, 100, 10**6])
+def test_iter_byte_chunks(chunk_bytes):
+    data = b'a\tb\n' + b'ccc\td\n' * 20 + b'no newline'
+    chunks = list(iter_byte_chunks(io.BytesIO(data), chunk_bytes))
+    assert b''.join(chunks) == data
+    # complete lines, except the last line of the file
+    assert all(chunk.endswith(b'\n') for chunk in chunks[:-1])
+
+def test_iter_file_chunks():
+    stream = io.BytesIO(redfin_tsv())
+    columns = read_file_columns(stream, VARIABLES)
+    df = pd.concat(iter_file_chunks(stream, columns, get_column_dtypes(columns, VARIABLES)))
+    assert len(df) == 12
+    assert df['region_id'].dtype == 'int64'
+    assert df['active_listings'].dtype == 'float64'
+    assert df['median_active_list_price'].isna().sum() == 3
+    assert df['region_id'].is_monotonic_increasing
+
+def test_read_file_columns_missing_variable():
+    with pytest.raises(RuntimeError):
+        read_file_columns(io.BytesIO(redfin_tsv()), VARIABLES + ['not_a_variable'])
+
+@pytest.mark.parametrize('compress', [True, False])
+def test_redfin_download(serve, tmp_path, compress):
+    data = redfin_tsv()
+    body = gzip.compress(data) if compress else data
+    serve(body, headers={'ETag': '"abc"', 'Last-Modified': 'Sun, 02 Jan 2022 00:00:00 GMT'})
+    archive_file = tmp_path / 'temp.download'
+
+    with RedfinDownload('http://redfin', archive_file) as download:
+        assert download.compressed == compress
+        assert download.stream.readline() == data.split(b'\n')[0] + b'\n'
+        # the rest is read by finish, on exit
+
+    assert download.md5 == hashlib.md5(body).hexdigest()
+    assert archive_file.read_bytes() == body
+    assert download.etag == '"abc"'
+    assert download.last_modified == 'Sun, 02 Jan 2022 00:00:00 GMT'
+    assert download.response.closed
+
+def test_redfin_download_finish(serve, tmp_path):
+    data = redfin_tsv()
+    serve(gzip.compress(data))
+    with RedfinDownload('http://redfin', tmp_path / 'temp.download') as download:
+        assert download.stream.read() == data
+        md5 = download.finish()
+        assert md5 == download.finish() == hashlib.md5(gzip.compress(data)).hexdigest()
+    assert download.md5 == md5
+
+def test_redfin_download_not_modified(serve, tmp_path):
+    requests_made = serve(b'', status_code=304)
+    with RedfinDownload('http://redfin', tmp_path / 'temp.download', etag='"abc"') as download:
+        assert download.not_modified
+    assert requests_made == [{'If-None-Match': '"abc"'}]
+    assert not (tmp_path / 'temp.download').exists()
+
+def test_load_from_download(serve, tmp_path):
+    serve(gzip.compress(redfin_tsv()))
+    sqlite_file = tmp_path / 'data.sqlite'
+    with RedfinDownload('http://redfin', tmp_path / 'temp.download') as download:
+        n_rows, _ = load_weekly_data(download.stream, sqlite_file, VARIABLES)
+
+    assert n_rows == 12
+    with sqlite3.connect(sqlite_file) as con:
+        assert con.execute('select count(*) from weekly_data_raw').fetchone()[0] == 12
+        assert con.execute('select count(*) from timeperiod_info').fetchone()[0] == 4
+        assert con.execute('select region_id, region_name from region_info').fetchall() == [
+            (1, 'County 1'), (2, 'County 2'), (3, 'County 3')]
+
+def edit_tsv(data, edit):
+    """ data with edit(fields) applied to the fields of each row, returning None to drop it """
+    header, *lines = data.decode().splitlines()
+    rows = [edit(line.split('\t')) for line in lines]
+    return ('\n'.join([header] + ['\t'.join(r) for r in rows if r is not None]) + '\n').encode()
+
+@pytest.fixture
+def database(tmp_path):
+    sqlite_file = tmp_path / 'data.sqlite'
+    load_weekly_data(io.BytesIO(redfin_tsv()), sqlite_file, VARIABLES)
+    build_map_snapshot_table(sqlite_file, VARIABLES)
+    return sqlite_file
+
+def read_table(sqlite_file, table):
+    with sqlite3.connect(sqlite_file) as con:
+        return pd.read_sql(f'select * from {table}', con)
+
+def upsert(database, data, caplog, **kwargs):
+    """ Upsert data into database, returning the rows read and the rows written """
+    caplog.clear()
+    with caplog.at_level('INFO'):
+        n_rows, _ = upsert_weekly_data(io.BytesIO(data), database, VARIABLES, **kwargs)
+    message = [r.getMessage() for r in caplog.records if 'inserted or updated' in r.getMessage()][-1]
+    return n_rows, int(message.split('. ')[-1].split()[0])
+
+def test_upsert_unchanged(database, caplog):
+    before = read_table(database, 'weekly_data_raw')
+    assert upsert(database, redfin_tsv(), caplog) == (12, 0)
+    assert read_table(database, 'weekly_data_raw').equals(before)
+
+def test_upsert_changes(database, caplog):
+    def edit(fields):
+        if fields[0] == '2' and fields[5] == '2022-01-23':
+            fields[6] = '99'
+        return fields
+    # one changed row, and region 4 with 4 new rows
+    data = edit_tsv(redfin_tsv(n_regions=4), edit)
+    assert upsert(database, data, caplog) == (16, 5)
+
+    for table in ['weekly_data_raw', 'map_snapshot']:
+        df = read_table(database, table)
+        assert len(df) == 16
+        assert df.query('region_id == 2 and active_listings == 99').shape[0] == 1
+    assert read_table(database, 'region_info')['region_id'].tolist() == [1, 2, 3, 4]
+
+def test_upsert_new_period(database, caplog):
+    # the last week moves on two weeks, so is new rows rather than changed ones
+    data = redfin_tsv().replace(b'2022-01-23', b'2022-02-06')
+    assert upsert(database, data, caplog) == (12, 3)
+    assert len(read_table(database, 'timeperiod_info')) == 5
+    assert len(read_table(database, 'weekly_data_raw')) == 15
+
+def test_upsert_renamed_region(database, caplog):
+    data = redfin_tsv().replace(b'County 1', b'Renamed')
+    assert upsert(database, data, caplog) == (12, 0)
+    region_info = read_table(database, 'region_info')
+    assert region_info['region_name'].tolist() == ['Renamed', 'County 2', 'County 3']
+
+def test_upsert_rollback(database, caplog):
+    before = {t: read_table(database, t) for t in ['weekly_data_raw', 'map_snapshot', 'region_info']}
+    def before_commit(con):
+        # the changes are visible here, before the commit
+        assert con.execute('select count(*) from weekly_data_raw').fetchone()[0] == 16
+        raise AssertionError('failed validation')
+
+    with pytest.raises(AssertionError, match='failed validation'):
+        upsert_weekly_data(io.BytesIO(redfin_tsv(n_regions=4).replace(b'County 1', b'Renamed')),
+                           database, VARIABLES, before_commit=before_commit)
+    for table, df in before.items():
+        assert read_table(database, table).equals(df)
+
+@pytest.mark.parametrize('batch_size', [1, 2, 100])
+def test_region_timeseries(database, monkeypatch, batch_size):
+    monkeypatch.setattr(ingest_raw_data, 'REGION_BATCH_SIZE', batch_size)
+    build_region_timeseries_table(database, VARIABLES)
+    df = read_table(database, 'region_timeseries')
+    # every region, also with fewer regions per read than there are
+    assert len(df) == 3 * (len(VARIABLES) + 1)
+    
+    blobs = df.set_index(['region_id', 'variable'])['data']
+    period_end = np.frombuffer(blobs[(2, 'period_end')], dtype='<i4')
+    assert (np.diff(period_end) == 7).all()
+    assert np.frombuffer(blobs[(2, 'active_listings')], dtype='<f4').tolist() == [20, 21, 22, 23]
+    assert np.isnan(np.frombuffer(blobs[(2, 'median_active_list_price')], dtype='<f4')[1])
+
+def test_snapshot_stats(database, monkeypatch):
+    monkeypatch.setattr(ingest_raw_data, 'STATS_VARIABLE_BATCH_SIZE', 1)
+    build_snapshot_stats_tables(database, VARIABLES)
+    snapshot_stats = read_table(database, 'snapshot_stats')
+    # 4 dates of 'all' and 'counties' for each variable
+    assert len(snapshot_stats) == 4 * 2 * len(VARIABLES)
+    global_stats = read_table(database, 'global_stats').set_index(['geo_type', 'variable'])
+    assert global_stats.loc[('all', 'active_listings'), 'p50'] == pytest.approx(21.5)
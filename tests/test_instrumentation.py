@@ -0,0 +1,79 @@
+import pytest
+
+import instrumentation
+from instrumentation import Histogram, instrument_callback, register_collector, render_metrics, span
+
+
+def parse(lines):
+    """ {sample name with labels: value} of rendered metric lines """
+    return {line.rsplit(' ', 1)[0]: float(line.rsplit(' ', 1)[1])
+            for line in lines if not line.startswith('#')}
+
+
+@pytest.fixture
+def fresh_metrics(monkeypatch):
+    monkeypatch.setattr(instrumentation, 'enabled', True)
+    monkeypatch.setattr(instrumentation, '_collectors', [])
+    for name in ['callback_seconds', 'stage_seconds']:
+        h = getattr(instrumentation, name)
+        monkeypatch.setattr(instrumentation, name, Histogram(h.name, h.help_text, h.label_names))
+
+
+def test_histogram_buckets():
+    h = Histogram('t', 'test', ('callback',), buckets=(0.1, 1.0))
+    # bucket bounds are inclusive, as le says
+    for seconds in [0.05, 0.1, 0.5, 1.0, 5.0]:
+        h.observe(('a',), seconds)
+    samples = parse(h.render())
+    assert samples['t_bucket{callback="a",le="0.1"}'] == 2
+    assert samples['t_bucket{callback="a",le="1.0"}'] == 4
+    assert samples['t_bucket{callback="a",le="+Inf"}'] == 5
+    assert samples['t_count{callback="a"}'] == 5
+    assert samples['t_sum{callback="a"}'] == pytest.approx(6.65)
+
+
+def test_histogram_series():
+    h = Histogram('t', 'test', ('callback', 'stage'), buckets=(0.1,))
+    h.observe(('b', 'query'), 0.01)
+    h.observe(('a', 'figure'), 1.0)
+    lines = h.render()
+    assert lines[:2] == ['# HELP t test', '# TYPE t histogram']
+    # one series per label values, sorted
+    assert lines[2] == 't_bucket{callback="a",stage="figure",le="0.1"} 0'
+    samples = parse(lines)
+    assert samples['t_count{callback="a",stage="figure"}'] == 1
+    assert samples['t_count{callback="b",stage="query"}'] == 1
+    assert samples['t_bucket{callback="b",stage="query",le="0.1"}'] == 1
+
+
+def test_render_metrics(fresh_metrics):
+    @instrument_callback
+    def update(x):
+        with span('query'):
+            pass
+        return x
+
+    assert update(1) == 1
+    # outside a callback a span records nothing
+    with span('query'):
+        pass
+    register_collector(lambda: {'cache_entries': ('gauge', 'Entries in the cache', 3)})
+
+    text = render_metrics()
+    assert text.endswith('\n')
+    lines = text.splitlines()
+    samples = parse(lines)
+    assert samples['dash_callback_seconds_count{callback="update"}'] == 1
+    assert samples['dash_callback_stage_seconds_count{callback="update",stage="query"}'] == 1
+    assert '# TYPE cache_entries gauge' in lines
+    assert samples['cache_entries'] == 3
+
+
+def test_disabled(fresh_metrics, monkeypatch):
+    monkeypatch.setattr(instrumentation, 'enabled', False)
+
+    def update():
+        return 1
+
+    assert instrument_callback(update) is update
+    assert parse(render_metrics().splitlines()) == {}
@@ -0,0 +1,127 @@
+import threading
+
+import numpy as np
+import pytest
+
+from snapshot_cache import SnapshotCache
+
+N_REGIONS = 100
+# bytes of each entry, int32 region ids and float32 values
+ENTRY_BYTES = N_REGIONS * 8
+
+
+class StubLoad:
+    """ Stands in for SnapshotCache.load, counting the loads of each key """
+    def __init__(self):
+        self.calls = []
+        self.release = threading.Event()
+        self.release.set()
+        self.started = threading.Event()
+
+    def __call__(self, variable, duration, period_end, data_version):
+        self.calls.append((variable, duration, period_end, data_version))
+        self.started.set()
+        assert self.release.wait(5)
+        region_ids = np.arange(N_REGIONS, dtype=np.int32)
+        values = np.full(N_REGIONS, period_end, dtype=np.float32)
+        return region_ids, values
+
+
+@pytest.fixture
+def cache():
+    cache = SnapshotCache(max_bytes=3 * ENTRY_BYTES, prefetch_workers=2)
+    cache.load = StubLoad()
+    return cache
+
+
+def key(period_end, data_version='v1'):
+    return ('Price', 4, period_end, data_version)
+
+
+def test_hits_and_misses(cache):
+    region_ids, values = cache.get(*key(1))
+    assert (values == 1).all()
+    cache.get(*key(1))
+    cache.get(*key(2))
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses']) == (1, 2)
+    assert stats['entries'] == 2
+    assert stats['bytes'] == 2 * ENTRY_BYTES
+    assert cache.load.calls == [key(1), key(2)]
+
+
+def test_lru_eviction(cache):
+    for p in [1, 2, 3]:
+        cache.get(*key(p))
+    # 1 is now the most recently used, so 2 goes first
+    cache.get(*key(1))
+    cache.get(*key(4))
+    stats = cache.stats()
+    assert stats['evictions'] == 1
+    assert stats['bytes'] == 3 * ENTRY_BYTES
+    assert list(cache._entries) == [key(3), key(1), key(4)]
+
+
+def test_entry_larger_than_max_bytes_is_kept(cache):
+    cache.max_bytes = ENTRY_BYTES // 2
+    cache.get(*key(1))
+    cache.get(*key(2))
+    # only the newest, over the limit, rather than nothing at all
+    assert list(cache._entries) == [key(2)]
+
+
+def test_prefetch_deduplicates(cache):
+    cache.load.release.clear()
+    futures = cache.prefetch([key(1), key(2), key(1)])
+    assert len(futures) == 2
+    # loading, so not started again
+    assert cache.prefetch([key(1)]) == []
+    assert cache.stats()['loading'] == 2
+    cache.load.release.set()
+    for future in futures:
+        future.result(5)
+    assert cache.prefetch([key(1), key(2)]) == []
+    assert sorted(cache.load.calls) == [key(1), key(2)]
+    assert cache.stats()['loading'] == 0
+
+
+def test_get_waits_for_prefetch(cache):
+    cache.load.release.clear()
+    cache.prefetch([key(1)])
+    assert cache.load.started.wait(5)
+    result = []
+    getter = threading.Thread(target=lambda: result.append(cache.get(*key(1))))
+    getter.start()
+    cache.load.release.set()
+    getter.join(5)
+    assert (result[0][1] == 1).all()
+    # the prefetch load only
+    assert cache.load.calls == [key(1)]
+
+
+def test_prewarm_skips_cached(cache):
+    cache.get(*key(1))
+    cache.prewarm([key(1), key(2)])
+    assert cache.load.calls == [key(1), key(2)]
+    assert cache.stats()['entries'] == 2
+
+
+def test_clear(cache):
+    cache.get(*key(1))
+    cache.clear()
+    stats = cache.stats()
+    assert (stats['entries'], stats['bytes']) == (0, 0)
+    cache.get(*key(1))
+    assert cache.load.calls == [key(1), key(1)]
+
+
+def test_clear_during_prefetch(cache):
+    cache.load.release.clear()
+    futures = cache.prefetch([key(1)])
+    assert cache.load.started.wait(5)
+    cache.clear()
+    cache.load.release.set()
+    futures[0].result(5)
+    # loaded before the clear, so not cached after it
+    stats = cache.stats()
+    assert (stats['entries'], stats['loading']) == (0, 0)
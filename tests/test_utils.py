@@ -0,0 +1,63 @@
+import sqlite3
+
+import pytest
+
+import utils
+from utils import get_data_version
+
+
+@pytest.fixture
+def db_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, '_db_pools', dict())
+    monkeypatch.setattr(utils, '_data_versions', dict())
+    db_file = tmp_path / 'data.sqlite'
+    with sqlite3.connect(db_file) as con:
+        con.execute('create table data_info (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID;')
+        con.execute("insert into data_info values ('md5sum', 'v1');")
+    con.close()
+    return db_file
+
+
+def set_version(con, version):
+    con.execute("update data_info set value = ? where key = 'md5sum';", (version,))
+    con.commit()
+
+
+def test_data_version_incremental(db_file, monkeypatch):
+    monkeypatch.setitem(utils.cfg, 'sqlite_immutable', False)
+    # as upsert_weekly_data, which keeps the file in WAL mode
+    writer = sqlite3.connect(db_file)
+    writer.execute('PRAGMA journal_mode = WAL;')
+    assert get_data_version(db_file) == 'v1'
+    
+    file_id = utils._db_file_id(db_file)
+    set_version(writer, 'v2')
+    # the commit is in the -wal file, the database file is untouched
+    assert utils._db_file_id(db_file) == file_id
+    assert get_data_version(db_file) == 'v2'
+    writer.close()
+
+
+def test_data_version_full(db_file, tmp_path, monkeypatch):
+    monkeypatch.setitem(utils.cfg, 'sqlite_immutable', True)
+    assert get_data_version(db_file) == 'v1'
+    
+    # a new database swapped in, as in ingest_raw_data.py
+    new_file = tmp_path / 'temp.sqlite'
+    with sqlite3.connect(new_file) as con:
+        con.execute('create table data_info (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID;')
+        con.execute("insert into data_info values ('md5sum', 'v2');")
+    con.close()
+    new_file.replace(db_file)
+    assert get_data_version(db_file) == 'v2'
+    
+    # missing for a moment mid swap
+    db_file.unlink()
+    assert get_data_version(db_file) == 'v2'
+
+
+def test_data_version_without_data_info(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, '_data_versions', dict())
+    db_file = tmp_path / 'old.sqlite'
+    sqlite3.connect(db_file).execute('create table t (x);')
+    assert get_data_version(db_file) == ''
@@ -1,71 +1,485 @@
 import os
 import json
+import numpy as np
 import pandas as pd
 import logging
 from copy import deepcopy
 
-import geopandas as gpd
+import pickle
 import sqlite3
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+from pathlib import Path
 
 from config import config as cfg
 
-def get_geo_data():
+# {db_file: ConnectionPool} of this process, see db_connection
+_db_pools = dict()
+_db_pools_lock = threading.Lock()
+# Pools inherited from a parent process. They are kept referenced, and so 
+# never garbage collected, since closing their connections here would also 
+# release the parent's sqlite locks on the file.
+_inherited_db_pools = []
+
+def _open_db_connection(db_file):
+    uri = Path(db_file).resolve().as_uri() + '?mode=ro'
+    if cfg['sqlite_immutable']:
+        uri += '&immutable=1'
+    
+    # pooled connections are used by one thread at a time, but not always the same one
+    con = sqlite3.connect(uri, uri=True, check_same_thread=False)
+    con.execute(f"PRAGMA cache_size = -{cfg['sqlite_cache_mb'] * 1024};")
+    con.execute(f"PRAGMA mmap_size = {cfg['sqlite_mmap_mb'] * 1024**2};")
+    con.execute('PRAGMA query_only = 1;')
+    return con
+
+def _db_file_id(db_file):
+    """ (inode, mtime) of db_file, or None if it does not exist """
+    try:
+        stat = os.stat(db_file)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns)
+
+class ConnectionPool:
+    """ 
+    Read only connections to one version (inode) of a database file, shared by 
+    all threads of a process. Idle connections are reused by whichever thread 
+    asks next, so there is no reconnecting when threads come and go. 
+    """
+    def __init__(self, db_file, file_id):
+        self.db_file = db_file
+        self.file_id = file_id
+        self.pid = os.getpid()
+        self.retired = False
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        logging.info(f'opening read only connection to {self.db_file}')
+        return _open_db_connection(self.db_file)
+
+    def release(self, con):
+        with self._lock:
+            if not self.retired:
+                self._idle.append(con)
+                return
+        con.close()
+
+    def retire(self):
+        """ Close the idle connections, and the others as they are released """
+        with self._lock:
+            self.retired = True
+            idle, self._idle = self._idle, []
+        for con in idle:
+            con.close()
+
+def reset_db_connections():
+    """ 
+    Set aside all connection pools, without closing them. For gunicorn 
+    post_fork, so a worker never touches connections opened before the fork.
+    """
+    with _db_pools_lock:
+        _inherited_db_pools.extend(_db_pools.values())
+        _db_pools.clear()
+
+def _get_db_pool(db_file):
+    file_id = _db_file_id(db_file)
+    with _db_pools_lock:
+        pool = _db_pools.get(db_file)
+        if pool is not None and pool.pid != os.getpid():
+            # inherited from a parent process, whose connections they are
+            _inherited_db_pools.append(pool)
+            pool = None
+        if pool is not None and (pool.file_id == file_id or file_id is None):
+            # a missing file is a moment in a swap, the open connections still 
+            # read the previous one
+            return pool
+        if file_id is None:
+            raise FileNotFoundError(f'database file {db_file} does not exist')
+        if pool is not None:
+            pool.retire()
+        pool = _db_pools[db_file] = ConnectionPool(db_file, file_id)
+        return pool
+
+@contextmanager
+def db_connection(db_file=None):
     """ 
-    Return 2 dictionaries. One with geodata as a geopandas dataframe, another
-    with the underlying data path.
+    A read only connection to db_file, data_db by default, from the per 
+    process pool. Used as 
+    
+        with db_connection() as con:
+            ...
+    
+    The file is checked every time, and if ingest_raw_data.py has swapped a 
+    new database in (ie. a new inode), or the process was forked, connections
+    are from a new pool against the current file. 
+    """
+    pool = _get_db_pool(str(db_file or cfg['data_db']))
+    con = pool.acquire()
+    try:
+        yield con
+    finally:
+        pool.release(con)
+
+_data_versions = dict()
+
+def get_data_version(db_file=None):
+    """
+    The md5 of the redfin file db_file was built from, as recorded by 
+    ingest_raw_data.py in the data_info table. '' for databases without one.
     
-    {'counties':gpd.GeoDataFrame, 'metros':gpd.GeoDataFrame}, ('counties':'filename','metros':'filename')
+    With sqlite_immutable, ie. databases replaced rather than updated, it is
+    only queried again when the file changes. Otherwise it is queried every
+    time, since an update in WAL mode goes to the -wal file and leaves the 
+    database file as it was. That is one lookup on a pooled connection.
     """
-    geo_data = dict()
-    geo_data_paths = dict()
+    db_file = str(db_file or cfg['data_db'])
+    file_id = _db_file_id(db_file)
+    
+    if db_file in _data_versions:
+        current_file_id, version = _data_versions[db_file]
+        # missing only for a moment while ingest swaps files
+        if file_id is None or (current_file_id == file_id and cfg['sqlite_immutable']):
+            return version
+    
+    try:
+        with db_connection(db_file) as con:
+            row = con.execute("SELECT value FROM data_info WHERE key = 'md5sum';").fetchone()
+    except sqlite3.OperationalError:
+        # no data_info table, from before it was added
+        row = None
+    version = row[0] if row else ''
+    
+    _data_versions[db_file] = (file_id, version)
+    return version
+
+def get_geodata_tier_file(geo_type, tier):
+    data_file = Path(cfg['geodata_files'][geo_type])
+    return f'{data_file.stem}_{tier}{data_file.suffix}'
+
+def get_geo_data_tier_paths():
+    """ 
+    Return {geo_type: {tier: filename}} for the tiers in config geodata_tiers. 
+    If a tier file has not been written the full geodata file is used instead.
+    """
+    tier_paths = dict()
     for geo_type, data_file in cfg['geodata_files'].items():
-        #fname = f'geodata_{region}.json'
-        geo_data_paths[geo_type] = data_file
+        tier_paths[geo_type] = dict()
+        for tier in cfg['geodata_tiers']:
+            tier_file = get_geodata_tier_file(geo_type, tier)
+            if Path(cfg['assets dir']).joinpath(tier_file).exists():
+                tier_paths[geo_type][tier] = tier_file
+            else:
+                tier_paths[geo_type][tier] = data_file
+
+    return tier_paths
+
+def get_geodata_tier(zoom):
+    """ The most detailed geodata tier to use at a map zoom level """
+    tiers = sorted(cfg['geodata_tiers'].items(), key=lambda t: t[1]['min_zoom'])
+    zoom_tier = tiers[0][0]
+    for tier, tier_info in tiers:
+        if zoom >= tier_info['min_zoom']:
+            zoom_tier = tier
+    return zoom_tier
+
+def get_geo_feature_index(geo_type, tier):
+    """ 
+    build_geo_feature_index of the geodata file of geo_type at tier, the same
+    file as the map it highlights, see get_geo_data_tier_paths. Each file is
+    only read the first time it is needed, eg. for a map highlight.
+    """
+    return _load_geo_feature_index(get_geo_data_tier_paths()[geo_type][tier])
+
+@lru_cache(maxsize=None)
+def _load_geo_feature_index(filename):
+    # by file, since tiers without their own file share the full one
+    with open(Path(cfg['assets dir']).joinpath(filename)) as f:
+        return build_geo_feature_index(json.load(f))
 
-        infile = cfg['assets dir'].joinpath(data_file)
-        geo_data[geo_type] = gpd.read_file(infile)
+class GeoFeatureIndex:
+    """
+    Read only {region_id: feature bytes} lookup. 
+    
+    All features are held in one bytes buffer, with numpy arrays of the sorted
+    region_ids and their offsets, rather than a dict of thousands of small 
+    objects. So when it is built before gunicorn forks, workers keep sharing 
+    the pages instead of copying them as reference counts change.
+    """
+    def __init__(self, features):
+        self.region_ids = np.array(sorted(features), dtype=np.int64)
+        parts = [features[r] for r in self.region_ids]
+        self.offsets = np.cumsum([0] + [len(p) for p in parts])
+        self.buffer = b''.join(parts)
 
-    return geo_data, geo_data_paths
+    def _position(self, region_id):
+        i = np.searchsorted(self.region_ids, region_id)
+        if i < len(self.region_ids) and self.region_ids[i] == region_id:
+            return i
+        return None
 
-# local_db = duckdb.connect()
+    def __contains__(self, region_id):
+        return self._position(region_id) is not None
 
-# weekly_dir_parquet_glob = "{}/**/*.parquet".format(cfg['data_dirs']['weekly_data_by_region'])
+    def __getitem__(self, region_id):
+        i = self._position(region_id)
+        if i is None:
+            raise KeyError(region_id)
+        return self.buffer[self.offsets[i]:self.offsets[i + 1]]
 
-# q = f"""
-# CREATE VIEW weekly_data_by_region AS
-# SELECT * from read_parquet('{weekly_dir_parquet_glob}');
-# """
-# local_db.execute(q)
+    def __len__(self):
+        return len(self.region_ids)
+
+def build_geo_feature_index(geojson):
+    """ 
+    Make a GeoFeatureIndex from a geojson FeatureCollection, where each 
+    feature is already serialized to geojson bytes. Shapes without a 
+    region_id are dropped.
+    """
+    features = dict()
+    for feature in geojson['features']:
+        region_id = feature['properties'].get('region_id')
+        if region_id is None or pd.isnull(region_id):
+            continue
+        features[int(region_id)] = json.dumps(feature, separators=(',', ':')).encode()
+    
+    return GeoFeatureIndex(features)
+
+def get_highlight_geojson(feature_index, region_ids):
+    """ 
+    A geojson FeatureCollection of only region_ids, made by joining the 
+    pre-serialized features from build_geo_feature_index.
+    """
+    features = b','.join([feature_index[r] for r in region_ids if r in feature_index])
+    return json.loads(b'{"type":"FeatureCollection","features":[' + features + b']}')
+
+def get_vector_tile(geo_type, z, x, y):
+    """ 
+    Return the gzipped vector tile z/x/y (in XYZ order) for geo_type from its 
+    MBTiles file, or None if there is no tile there. Raises FileNotFoundError
+    if the MBTiles file does not exist.
+    """
+    q = """
+    SELECT tile_data FROM tiles 
+    WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?
+    """
+    tms_row = (2 ** z) - 1 - y
+    with db_connection(cfg['vector_tile_files'][geo_type]) as con:
+        result = con.execute(q, (z, x, tms_row)).fetchone()
+    return None if result is None else result[0]
+
+# weekly_data_raw and map_snapshot store dates as day numbers and durations 
+# as the integer number of weeks. These convert to and from the strings used 
+# everywhere else, eg. '2024-01-21' and '4 weeks'.
+EPOCH = pd.Timestamp('1970-01-01')
+
+def duration_code(duration):
+    """ '4 weeks' -> 4 """
+    return int(duration.split()[0])
+
+def date_to_day(date):
+    """ Days since 1970-01-01 of a 'YYYY-MM-DD' date, or a Series of them """
+    if isinstance(date, pd.Series):
+        return (pd.to_datetime(date, format='%Y-%m-%d') - EPOCH).dt.days
+    return (pd.Timestamp(date) - EPOCH).days
+
+def day_to_date(days):
+    """ 'YYYY-MM-DD' dates of a Series of day numbers """
+    return (EPOCH + pd.to_timedelta(days, unit='D')).dt.strftime('%Y-%m-%d')
+
+# Parquet datasets written by ingest_raw_data.write_parquet_datasets. Both are 
+# partitioned on duration, with one file per duration sorted on the lookup key
+# and written in small row groups. So the filters below prune by partition,
+# then by row group statistics, and only the requested variable column is read. 
+
+def _parquet_data_for_region_and_var(region_ids, variable, duration):
+    return pd.read_parquet(
+        cfg['data_dirs']['weekly_data_by_region'],
+        columns = ['region_id', 'period_end', variable],
+        filters = [('duration', '=', duration_code(duration)), ('region_id', 'in', list(region_ids))],
+        )
+
+def _parquet_data_for_timeperiod_and_var(variable, period_end, duration):
+    return pd.read_parquet(
+        cfg['data_dirs']['weekly_data_by_date'],
+        columns = ['region_id', variable],
+        filters = [('duration', '=', duration_code(duration)), ('period_end', '=', date_to_day(period_end))],
+        )
+
+# Arrays written by ingest_raw_data.write_npy_cube. Each is memory mapped once
+# per process, and mapped again if ingest has replaced the file.
+_npy_arrays = dict()
+
+def _npy_array(name):
+    path = str(Path(cfg['data_dirs']['weekly_data_cube']).joinpath(f'{name}.npy'))
+    stat = os.stat(path)
+    file_id = (stat.st_ino, stat.st_mtime_ns)
+    
+    if path in _npy_arrays:
+        current_file_id, array = _npy_arrays[path]
+        if current_file_id == file_id:
+            return array
+    
+    array = np.load(path, mmap_mode='r')
+    _npy_arrays[path] = (file_id, array)
+    return array
+
+def _npy_region_columns(region_ids):
+    """ (sorted region_ids present in the cube, their column numbers) """
+    regions = _npy_array('regions')
+    region_ids = np.unique(np.asarray(region_ids, dtype=np.int32))
+    cols = np.searchsorted(regions, region_ids).clip(max=len(regions) - 1)
+    found = regions[cols] == region_ids
+    return region_ids[found], cols[found]
+
+def _npy_data_for_region_and_var(region_ids, variable, duration):
+    code = duration_code(duration)
+    periods = _npy_array(f'periods_{code}')
+    region_ids, cols = _npy_region_columns(region_ids)
+    # [n_periods, n_selected], transposed so each region's periods are together
+    values = _npy_array(f'{variable}_{code}')[:, cols].T
+    return pd.DataFrame({
+        'region_id'  : np.repeat(region_ids, len(periods)),
+        'period_end' : np.tile(periods, len(region_ids)),
+        variable     : values.ravel(),
+        })
+
+def _npy_data_for_timeperiod_and_var(variable, period_end, duration):
+    code = duration_code(duration)
+    periods = _npy_array(f'periods_{code}')
+    row = np.searchsorted(periods, date_to_day(period_end))
+    if row == len(periods) or periods[row] != date_to_day(period_end):
+        return pd.DataFrame({'region_id': np.empty(0, np.int32), variable: np.empty(0, np.float32)})
+    return pd.DataFrame({
+        'region_id' : _npy_array('regions'),
+        variable    : _npy_array(f'{variable}_{code}')[row],
+        })
 
 def get_all_data_for_region_and_var(region_ids, variable, duration='1 weeks'):
-    region_in_str = ','.join([str(i) for i in region_ids])
+    """ This one is for timeseries data. """
+    if cfg['data_engine'] == 'parquet':
+        df = _parquet_data_for_region_and_var(region_ids, variable, duration)
+    elif cfg['data_engine'] == 'npy':
+        df = _npy_data_for_region_and_var(region_ids, variable, duration)
+    else:
+        region_in_str = ','.join([str(i) for i in region_ids])
+        q = f"""
+        SELECT region_id, period_end, {variable}  
+        FROM weekly_data_raw 
+        WHERE duration = {duration_code(duration)}
+        AND region_id in ({region_in_str});
+        """
+        with db_connection() as con:
+            df = pd.read_sql(q, con)
+    
+    df['period_end'] = day_to_date(df['period_end'])
+    df['duration'] = duration
+    return df
+
+def get_region_timeseries(region_ids, variable, duration='1 weeks'):
+    """
+    Timeseries of variable for region_ids, as a data.frame of region_id, 
+    period_end (datetime64) and variable. Sorted on region_id then period_end.
+    
+    With the sqlite engine this reads the region_timeseries blobs built in 
+    ingest_raw_data.py. Each is wrapped as a numpy array without copying, 
+    and the dates are already sorted. The npy engine slices the same from 
+    the cube.
+    """
+    if cfg['data_engine'] == 'npy':
+        # already in this order
+        df = _npy_data_for_region_and_var(region_ids, variable, duration)
+        df['period_end'] = df['period_end'].to_numpy().astype('datetime64[D]')
+        return df
+    elif cfg['data_engine'] != 'sqlite':
+        df = get_all_data_for_region_and_var(region_ids, variable, duration)
+        df['period_end'] = pd.to_datetime(df['period_end'])
+        return df[['region_id', 'period_end', variable]].sort_values(['region_id', 'period_end'], ignore_index=True)
+    
+    region_in_str = ','.join([str(int(i)) for i in region_ids])
     q = f"""
-    SELECT region_id, period_begin, period_end, duration, {variable}  
-    FROM weekly_data_raw 
-    WHERE region_id in ({region_in_str})
-    AND duration = '{duration}';
+    SELECT region_id, variable, data
+    FROM region_timeseries
+    WHERE duration = ?
+    AND region_id in ({region_in_str})
+    AND variable in ('period_end', ?)
+    ORDER BY region_id;
     """
-    with sqlite3.connect(cfg['data_db']) as con:
-        df = pd.read_sql(q, con)
+    blobs = {}
+    with db_connection() as con:
+        for region_id, name, data in con.execute(q, (duration_code(duration), variable)):
+            blobs[(region_id, name)] = data
     
-    return df
+    found_ids = sorted({region_id for region_id, _ in blobs})
+    days = [np.frombuffer(blobs[(r, 'period_end')], dtype='<i4') for r in found_ids]
+    values = [np.frombuffer(blobs[(r, variable)], dtype='<f4') for r in found_ids]
+    
+    return pd.DataFrame({
+        'region_id'  : np.repeat(found_ids, [len(d) for d in days]).astype(np.int64),
+        'period_end' : np.concatenate(days or [np.empty(0, '<i4')]).astype('datetime64[D]'),
+        variable     : np.concatenate(values or [np.empty(0, '<f4')]),
+        })
 
 LAST_PERIOD = '2024-01-21'
 
-#TODO: make a table optimized for this. make last
 def get_all_data_for_timeperiod_and_var(variable, period_end=LAST_PERIOD, duration='1 weeks'):
-    """This one is for map data"""
-    q = f"""
-    SELECT region_id, period_end, duration, {variable}  
-    FROM weekly_data_raw 
-    WHERE period_end = '{period_end}'
-    AND duration = '{duration}';
     """
-    with sqlite3.connect(cfg['data_db']) as con:
-        df = pd.read_sql(q, con)
+    This one is for map data. 
+    
+    Reads from the map_snapshot table built in ingest_raw_data.py, which is 
+    clustered on (duration, period_end, region_id) so this is a single range
+    read instead of a scan of weekly_data_raw.
+    """
+    if cfg['data_engine'] == 'parquet':
+        df = _parquet_data_for_timeperiod_and_var(variable, period_end, duration)
+    elif cfg['data_engine'] == 'npy':
+        df = _npy_data_for_timeperiod_and_var(variable, period_end, duration)
+    else:
+        q = f"""
+        SELECT region_id, {variable}  
+        FROM map_snapshot 
+        WHERE duration = {duration_code(duration)}
+        AND period_end = {date_to_day(period_end)};
+        """
+        with db_connection() as con:
+            df = pd.read_sql(q, con)
     
+    df['period_end'] = period_end
+    df['duration'] = duration
     return df
 
+def get_map_value_range(variable, duration, period_end, geo_type, scope='period'):
+    """
+    (p05, p95) of variable for the map, precomputed by ingest_raw_data.py. 
+    With scope 'period' over the regions of geo_type on period_end, with 
+    'global' over all dates so colours are comparable between dates. 
+    None if the database has no stats for it.
+    """
+    if scope == 'global':
+        q = """
+        SELECT p05, p95 FROM global_stats 
+        WHERE variable = ? AND duration = ? AND geo_type = ?;
+        """
+        params = (variable, duration_code(duration), geo_type)
+    else:
+        q = """
+        SELECT p05, p95 FROM snapshot_stats 
+        WHERE variable = ? AND duration = ? AND period_end = ? AND geo_type = ?;
+        """
+        params = (variable, duration_code(duration), date_to_day(period_end), geo_type)
+    
+    try:
+        with db_connection() as con:
+            return con.execute(q, params).fetchone()
+    except sqlite3.OperationalError:
+        # no stats tables, from before they were added
+        return None
+
 #TODO: make this a mapping with pretty var names
 def get_variable_info():
     return pd.read_csv(cfg['variable_info_file'])
@@ -74,35 +488,73 @@ def get_timeperiod_info():
     q = """
     SELECT * from timeperiod_info
     """
-    with sqlite3.connect(cfg['data_db']) as con:
+    with db_connection() as con:
         df = pd.read_sql(q, con)
     
     return df
 
-def get_end_dates_for_durations():
-    df = get_timeperiod_info()
+def get_end_dates_for_durations(time_period_info=None):
+    if time_period_info is None:
+        time_period_info = get_timeperiod_info()
     
-    duration_end_dates = {}
-    for duration in df.duration.unique():
-        # sort descending so most recent dates are 1st in drop down
-        duration_end_dates[duration] =  df.query("duration==@duration").period_end.sort_values(ascending=False).tolist()
-
-    return duration_end_dates
+    # sort descending so most recent dates are 1st in drop down
+    return {
+        duration: period_ends.sort_values(ascending=False).tolist()
+        for duration, period_ends in time_period_info.groupby('duration').period_end
+        }
 
-def get_all_region_info(return_mapping=True):
+def get_region_info_mapping(all_region_info):
+    """ {'counties':{region_id:region_name,...}, 'metros':{...}} from the region_info table """
     region_info = {}
+    region_info['counties'] = all_region_info.query("region_type=='county'").set_index('region_id').to_dict()['region_name']
+    region_info['metros'] = all_region_info.query("region_type=='metro'").set_index('region_id').to_dict()['region_name']
+    return region_info
 
+def get_all_region_info(return_mapping=True):
     q = """
     SELECT * FROM region_info
     """
-    with sqlite3.connect(cfg['data_db']) as con:
+    with db_connection() as con:
         all_region_info = pd.read_sql(q, con)
     
     if return_mapping:
         # Make a mapping of {region_id:region_name,...}
-        region_info['counties'] = all_region_info.query("region_type=='county'").set_index('region_id').to_dict()['region_name']
-        region_info['metros'] = all_region_info.query("region_type=='metro'").set_index('region_id').to_dict()['region_name']
-    
-        return region_info
+        return get_region_info_mapping(all_region_info)
     else:
         return all_region_info
+
+def build_app_lookups():
+    """ The lookup tables app.py needs at startup, from the database """
+    all_region_info = get_all_region_info(return_mapping=False)
+    time_period_info = get_timeperiod_info()
+    
+    return dict(
+        region_id_lut = get_region_info_mapping(all_region_info),
+        region_id_df  = all_region_info,
+        time_period_info = time_period_info,
+        duration_period_end_dates = get_end_dates_for_durations(time_period_info),
+        data_version = get_data_version(),
+        )
+
+def write_app_lookups_file():
+    """ Save build_app_lookups to the lookups_file, written by ingest_raw_data.py """
+    lookups_file = Path(cfg['lookups_file'])
+    temp_file = lookups_file.with_suffix('.temp')
+    with open(temp_file, 'wb') as f:
+        pickle.dump(build_app_lookups(), f, protocol=pickle.HIGHEST_PROTOCOL)
+    temp_file.replace(lookups_file)
+
+def get_app_lookups():
+    """ 
+    build_app_lookups, loaded from the lookups_file when config startup_mode 
+    is 'lookups_file' and it exists and matches the current database version. 
+    Otherwise from the database.
+    """
+    lookups_file = Path(cfg['lookups_file'])
+    if cfg['startup_mode'] == 'lookups_file' and lookups_file.exists():
+        with open(lookups_file, 'rb') as f:
+            app_lookups = pickle.load(f)
+        if app_lookups.get('data_version') == get_data_version():
+            return app_lookups
+        logging.warning(f'{lookups_file} does not match the database, building lookups from the database')
+    return build_app_lookups()
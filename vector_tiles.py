@@ -0,0 +1,85 @@
+"""
+Write region geometry as a Mapbox Vector Tile pyramid in an MBTiles file.
+
+MBTiles is a single sqlite file, with tiles stored gzipped in TMS row order.
+See https://github.com/mapbox/mbtiles-spec. Tiles are served from it by the
+/tiles endpoint in app.py.
+"""
+import gzip
+import sqlite3
+from pathlib import Path
+
+import mapbox_vector_tile
+import mercantile
+import pandas as pd
+from shapely.geometry import box
+
+TILE_EXTENT = 4096
+# buffer around each tile, in tile pixels, so lines at tile edges join cleanly
+TILE_BUFFER = 64
+
+
+def _tile_features(gdf_3857, feature_properties, bounds, tolerance):
+    minx, miny, maxx, maxy = bounds
+    buffer = (maxx - minx) * TILE_BUFFER / TILE_EXTENT
+    clip_box = box(minx - buffer, miny - buffer, maxx + buffer, maxy + buffer)
+
+    features = []
+    for i in gdf_3857.sindex.query(clip_box):
+        geom = gdf_3857.geometry.iloc[i].simplify(tolerance).intersection(clip_box)
+        if geom.is_empty:
+            continue
+        features.append({'geometry': geom, 'properties': feature_properties[i]})
+    return features
+
+
+def write_mbtiles(gdf, dest_file, layer_name, min_zoom, max_zoom, properties):
+    """
+    Write gdf into dest_file as layer_name for every zoom from min_zoom to max_zoom.
+    properties is a list of gdf columns to keep in each feature.
+
+    Geometry is simplified to about one tile pixel at each zoom. The file is
+    written under a temporary name and renamed into place at the end.
+    """
+    dest_file = Path(dest_file)
+    temp_file = dest_file.with_suffix('.temp')
+    if temp_file.exists():
+        temp_file.unlink()
+
+    gdf_3857 = gdf[['geometry']].to_crs('EPSG:3857')
+    # plain python values, without missing ones, which is what the tile encoder accepts
+    feature_properties = [
+        {k: v for k, v in record.items() if pd.notnull(v)}
+        for record in gdf[properties].astype(object).to_dict('records')
+        ]
+    west, south, east, north = gdf.to_crs('EPSG:4326').total_bounds
+
+    with sqlite3.connect(temp_file) as con:
+        con.execute('create table metadata (name text, value text);')
+        con.execute('create table tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob);')
+        con.executemany('insert into metadata values (?, ?)', [
+            ('name', layer_name),
+            ('format', 'pbf'),
+            ('minzoom', str(min_zoom)),
+            ('maxzoom', str(max_zoom)),
+            ('bounds', f'{west},{south},{east},{north}'),
+            ])
+
+        for tile in mercantile.tiles(west, south, east, north, zooms=range(min_zoom, max_zoom + 1)):
+            bounds = mercantile.xy_bounds(tile)
+            tolerance = (bounds.right - bounds.left) / TILE_EXTENT
+            features = _tile_features(gdf_3857, feature_properties, bounds, tolerance)
+            if not features:
+                continue
+
+            tile_data = mapbox_vector_tile.encode(
+                [{'name': layer_name, 'features': features}],
+                default_options = {'quantize_bounds': bounds, 'extents': TILE_EXTENT},
+                )
+            tms_row = (2 ** tile.z) - 1 - tile.y
+            con.execute('insert into tiles values (?, ?, ?, ?)',
+                        (tile.z, tile.x, tms_row, gzip.compress(tile_data)))
+
+        con.execute('create unique index tile_index on tiles (zoom_level, tile_column, tile_row);')
+
+    temp_file.rename(dest_file)